@@ -0,0 +1,1080 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tests: every parser and storage format must give the tree Parser builds,
+plus synthetic replays for what the files in testdata never use.
+
+Run from this directory with python -m unittest test_twrpy (or pytest).
+"""
+
+import errno
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from twrpy.batch import parse_many
+from twrpy.benchmark import compare
+from twrpy.cache import ParseCache
+from twrpy.codecs import get_codec
+from twrpy.columnar import RecordColumns, select_columns
+from twrpy.errors import InvalidDataStructureError, UnknownReplayFileError
+from twrpy.flat import from_parser, parse_flat
+from twrpy.index import RecordIndex, get_index, select_indexed
+from twrpy.nodes import RecordNode, RecordArrayNode, ChildNode
+from twrpy.parallel import ParallelParser
+from twrpy.parser import Parser, LazyParser, iterparse, StackParser, probe
+from twrpy.profiling import DecodeProfile
+from twrpy.reader import BinaryReader, MappedBinaryReader
+from twrpy.serializer import dump, dump_ndjson
+from twrpy.snapshot import load_snapshot, save_snapshot, Snapshot
+from twrpy.types import TypeCodes
+import twrpy.parser as parser_module
+
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testdata')
+REPLAYS = ['empire.replay', 'napoleon.replay', 'shogun2.replay', 'shogun2_ex.replay']
+
+
+def canon(value):
+    """
+    Comparable form of a node tree; floats are compared by repr so that NaN equals itself.
+    """
+    if isinstance(value, RecordNode):
+        return ('record', value.tag_name_index, value.version, value.offset,
+                [canon(child) for child in value.children], [canon(item) for item in value.values])
+    elif isinstance(value, RecordArrayNode):
+        return ('array', value.tag_name_index, value.version, value.offset, value.elements_length,
+                [canon(item) for item in value.values])
+    elif isinstance(value, ChildNode):
+        return ('element', [canon(child) for child in value.children], [canon(item) for item in value.values])
+    elif isinstance(value, list):
+        return [canon(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(canon(item) for item in value)
+    elif isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def is_record(value):
+    return isinstance(value, (RecordNode, RecordArrayNode))
+
+
+def walk(nodes):
+    """
+    Every record, record array and record array element below nodes.
+    """
+    stack = [node for node in nodes if is_record(node)]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, RecordArrayNode):
+            stack.extend(node.values)
+        else:
+            stack.extend(node.children)
+            stack.extend(value for value in node.values if is_record(value))
+
+
+def replay_path(name):
+    return os.path.join(TESTDATA, name)
+
+
+def open_reader(path):
+    fp = open(path, 'rb')
+    try:
+        return BinaryReader(fp)
+    finally:
+        fp.close()
+
+
+def parse_file(path, parser_class=Parser):
+    reader = open_reader(path)
+    return parser_class(reader, get_codec(reader))
+
+
+def parse_bytes(data, parser_class=Parser):
+    reader = BinaryReader(io.BytesIO(data))
+    return parser_class(reader, get_codec(reader))
+
+
+_expected = {}
+
+
+def expected_tree(name):
+    """
+    canon of the nodes Parser decodes from a replay in testdata.
+    """
+    if name not in _expected:
+        _expected[name] = canon(parse_file(replay_path(name)).nodes)
+    return _expected[name]
+
+
+class Output(list):
+    """
+    File-like object collecting what is written.
+    """
+
+    def write(self, text):
+        self.append(text)
+
+    def getvalue(self):
+        return ''.join(self)
+
+
+class CorpusTestCase(unittest.TestCase):
+
+    def check_corpus(self, parse):
+        """
+        parse(path) must return the nodes Parser decodes, for every replay in REPLAYS.
+        """
+        for name in REPLAYS:
+            self.assertEqual(canon(parse(replay_path(name))), expected_tree(name), name)
+
+
+PARSERS = [Parser, LazyParser, StackParser, parse_flat]
+
+
+class SyntheticTestCase(unittest.TestCase):
+    """
+    Hand-built ABCE replays: the root record (tag 0, version 1) holds the body, tag 1 is ITEM.
+    """
+
+    # offset of the first byte of the body
+    BODY_START = 24
+
+    def replay(self, body):
+        root = struct.pack('<BHBI', TypeCodes.RECODE, 0, 1, self.BODY_START + len(body)) + body
+        footer = struct.pack('<H', 2) + struct.pack('<H', 4) + b'root' + struct.pack('<H', 4) + b'ITEM'
+        return struct.pack('<IIII', 0xABCE, 0, 0, 16 + len(root)) + root + footer
+
+    def check_parsers(self, data, expected):
+        """
+        Every parser in PARSERS must decode data to expected (a canon tree).
+        """
+        for parser_class in PARSERS:
+            self.assertEqual(canon(parse_bytes(data, parser_class).nodes), expected, parser_class.__name__)
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def copy_replay(self, name):
+        path = os.path.join(self.tmp, name)
+        shutil.copy(replay_path(name), path)
+        return path
+
+
+class MappedReaderTest(CorpusTestCase):
+
+    def test_corpus(self):
+        def parse(path):
+            fp = open(path, 'rb')
+            try:
+                reader = MappedBinaryReader(fp)
+                try:
+                    return Parser(reader, get_codec(reader)).nodes
+                finally:
+                    reader.close()
+            finally:
+                fp.close()
+        self.check_corpus(parse)
+
+
+class ArrayNodeTest(SyntheticTestCase):
+
+    def test_fixed_width_arrays(self):
+        body = b''
+        for code, payload in [(TypeCodes.BOOL_ARRAY, b'\x01\x00'),
+                              (TypeCodes.INT16_ARRAY, struct.pack('<3h', 1, -2, 3)),
+                              (TypeCodes.UINT64_ARRAY, struct.pack('<Q', 2 ** 63)),
+                              (TypeCodes.INT32_ARRAY, b''),
+                              (TypeCodes.FLOAT32_ARRAY, struct.pack('<2f', 0.5, -1.5)),
+                              (TypeCodes.COORDINATES2D_ARRAY, struct.pack('<4f', 1, 2, 3, 4)),
+                              (TypeCodes.COORDINATES3D_ARRAY, struct.pack('<3f', 1, 2, 3)),
+                              (TypeCodes.ASCII_ARRAY, struct.pack('<H', 2) + b'ab' + struct.pack('<H', 0))]:
+            body += struct.pack('<BI', code, self.BODY_START + len(body) + 5 + len(payload)) + payload
+        values = [[True, False], [1, -2, 3], [2 ** 63], [], [repr(0.5), repr(-1.5)],
+                  [(repr(1.0), repr(2.0)), (repr(3.0), repr(4.0))], [(repr(1.0), repr(2.0), repr(3.0))],
+                  [b'ab', b'']]
+        self.check_parsers(self.replay(body), [('record', 0, 1, self.BODY_START + len(body), [], values)])
+
+    def test_partial_element(self):
+        # spans that end inside an element, followed by a value the leftover bytes would desync
+        for code, payload in [(TypeCodes.INT16_ARRAY, b'\x01\x00\x02\x00\x03'),
+                              (TypeCodes.INT32_24BIT_ARRAY, b'\x00\x00\x01\x00')]:
+            body = struct.pack('<BI', code, self.BODY_START + 5 + len(payload)) + payload
+            data = self.replay(body + struct.pack('<Bb', TypeCodes.INT8, -1))
+            for parser_class in PARSERS:
+                # LazyParser decodes the root's values when they are read
+                self.assertRaises(InvalidDataStructureError, lambda: canon(parse_bytes(data, parser_class).nodes))
+
+
+class DecoderTableTest(SyntheticTestCase):
+
+    def test_unknown_type_code(self):
+        self.assertRaises(InvalidDataStructureError, parse_bytes, self.replay(b'\x30'))
+
+
+class LazyParserTest(CorpusTestCase):
+
+    def test_corpus(self):
+        self.check_corpus(lambda path: parse_file(path, LazyParser).nodes)
+
+
+def record_tree(node, tags):
+    """
+    (tag, version, values, records) of a record, or of a record array element (no tag and version).
+    """
+    if isinstance(node, RecordArrayNode):
+        return (tags[node.tag_name_index], node.version, [], [record_tree(element, tags) for element in node.values])
+    records = [record_tree(child, tags) for child in list(node.children) + [v for v in node.values if is_record(v)]]
+    values = [canon(value) for value in node.values if not is_record(value)]
+    if isinstance(node, RecordNode):
+        return (tags[node.tag_name_index], node.version, values, records)
+    return (None, None, values, records)
+
+
+class IterparseTest(unittest.TestCase):
+
+    def event_tree(self, path):
+        """
+        record_tree of the top-level nodes, built from the events of iterparse.
+        """
+        top = (None, None, [], [])
+        stack = [top]
+        for event, data in iterparse(path):
+            if event == 'start_record':
+                node = (data[0], data[1], [], [])
+                stack[-1][3].append(node)
+                stack.append(node)
+            elif event == 'start_element':
+                node = (None, None, [], [])
+                stack[-1][3].append(node)
+                stack.append(node)
+            elif event == 'value':
+                stack[-1][2].append(canon(data[1]))
+            elif event == 'end_record':
+                self.assertEqual(stack.pop()[0], data)
+            else:
+                self.assertEqual(event, 'end_element')
+                self.assertEqual(stack.pop()[0], None)
+            self.assertTrue(stack)
+        self.assertEqual(stack, [top])
+        return top
+
+    def test_events(self):
+        for name in REPLAYS:
+            parser = parse_file(replay_path(name))
+            node = ChildNode()
+            node.values = parser.nodes
+            self.assertEqual(self.event_tree(replay_path(name)), record_tree(node, parser.footer['tags']), name)
+
+    def test_close_early(self):
+        closed = []
+
+        class Reader(MappedBinaryReader):
+            def close(self):
+                MappedBinaryReader.close(self)
+                closed.append(self)
+
+        parser_module.MappedBinaryReader = Reader
+        try:
+            events = iterparse(replay_path('empire.replay'))
+            next(events)
+            events.close()
+        finally:
+            parser_module.MappedBinaryReader = MappedBinaryReader
+        self.assertEqual(len(closed), 1)
+        self.assertRaises(ValueError, closed[0].map.read_byte)
+
+
+class StackParserTest(CorpusTestCase, SyntheticTestCase):
+
+    def test_corpus(self):
+        self.check_corpus(lambda path: parse_file(path, StackParser).nodes)
+
+    def test_deep_records(self):
+        depth = 5000
+        end = self.BODY_START + 8 * depth + 2
+        body = struct.pack('<BHBI', TypeCodes.RECODE, 1, 0, end) * depth + struct.pack('<Bb', TypeCodes.INT8, -1)
+        node = parse_bytes(self.replay(body), StackParser).nodes[0]
+        levels = 0
+        while node.children:
+            node = node.children[0]
+            levels += 1
+        self.assertEqual(levels, depth)
+        self.assertEqual(node.values, [-1])
+
+
+def record_rows(nodes):
+    """
+    (kind, tag name index, version, node) of every record in file order, like the rows of a
+    RecordIndex; record array elements are RECODE rows with the tag and version of their array.
+    """
+    rows = []
+    stack = [(node, None) for node in reversed(nodes) if is_record(node)]
+    while stack:
+        node, array = stack.pop()
+        if array is not None:
+            rows.append((TypeCodes.RECODE, array.tag_name_index, array.version, node))
+        elif isinstance(node, RecordArrayNode):
+            rows.append((TypeCodes.RECODE_ARRAY, node.tag_name_index, node.version, node))
+            stack.extend((element, node) for element in reversed(node.values))
+            continue
+        else:
+            rows.append((TypeCodes.RECODE, node.tag_name_index, node.version, node))
+        records = list(node.children) + [value for value in node.values if is_record(value)]
+        stack.extend((record, None) for record in reversed(records))
+    return rows
+
+
+class RecordIndexTest(SyntheticTestCase, TempDirTestCase):
+
+    def test_rows(self):
+        path = self.copy_replay('napoleon.replay')
+        index = get_index(path)
+        self.assertTrue(os.path.exists(RecordIndex.sidecar_path(path)))
+        rows = list(zip(index.type_codes, index.tags, index.versions))
+        self.assertEqual(rows, [row[:3] for row in record_rows(parse_file(path).nodes)])
+
+        loaded = get_index(path)
+        for name, typecode in RecordIndex._COLUMNS:
+            self.assertEqual(getattr(loaded, name), getattr(index, name), name)
+
+    def test_decode(self):
+        for name in REPLAYS:
+            path = self.copy_replay(name)
+            index = get_index(path)
+            parser = parse_file(path)
+            rows = record_rows(parser.nodes)
+            for record_id in range(0, len(index), 17):
+                node = index.decode(parser.reader, parser.codec, record_id)
+                self.assertEqual(canon(node), canon(rows[record_id][3]), (name, record_id))
+
+    def test_stale_sidecar(self):
+        # same size and so the same 16 byte header; only the modification time differs
+        values = self.replay(struct.pack('<Bb', TypeCodes.INT8, -1) * 8)
+        records = self.replay(struct.pack('<BHBI', TypeCodes.RECODE, 1, 0, self.BODY_START + 16) +
+                              struct.pack('<Bb', TypeCodes.INT8, -1) * 4)
+        self.assertEqual(values[:16], records[:16])
+        path = os.path.join(self.tmp, 'changed.replay')
+        with open(path, 'wb') as fp:
+            fp.write(values)
+        os.utime(path, (1000000000, 1000000000))
+        self.assertEqual(len(get_index(path)), 1)
+        with open(path, 'wb') as fp:
+            fp.write(records)
+        os.utime(path, (1000000001, 1000000001))
+        self.assertEqual(list(get_index(path).type_codes), [TypeCodes.RECODE, TypeCodes.RECODE])
+        self.assertEqual(len(RecordIndex.load(RecordIndex.sidecar_path(path))), 2)
+
+    def test_truncated_sidecar(self):
+        path = self.copy_replay('empire.replay')
+        count = len(get_index(path))
+        sidecar = RecordIndex.sidecar_path(path)
+        with open(sidecar, 'rb') as fp:
+            data = fp.read()
+        # one uint16 depth short: every column slice is still a whole number of items
+        with open(sidecar, 'wb') as fp:
+            fp.write(data[:-2])
+        self.assertRaises(ValueError, RecordIndex.load, sidecar)
+        self.assertEqual(len(get_index(path)), count)
+        self.assertEqual(len(RecordIndex.load(sidecar)), count)
+
+    def test_concurrent_saves(self):
+        path = self.copy_replay('napoleon.replay')
+        index = get_index(path, save=False)
+        sidecar = RecordIndex.sidecar_path(path)
+        errors = []
+
+        def work():
+            try:
+                for i in range(10):
+                    index.save(sidecar)
+                    self.assertEqual(len(RecordIndex.load(sidecar)), len(index))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['napoleon.replay', 'napoleon.replay.idx'])
+
+    def test_unwritable_directory(self):
+        path = self.copy_replay('napoleon.replay')
+
+        def mkstemp(*args):
+            raise OSError(errno.EACCES, 'Permission denied')
+
+        tempfile.mkstemp, original = mkstemp, tempfile.mkstemp
+        try:
+            index = get_index(path)
+        finally:
+            tempfile.mkstemp = original
+        self.assertEqual(len(index), len(get_index(path, save=False)))
+        self.assertFalse(os.path.exists(RecordIndex.sidecar_path(path)))
+
+
+def select_tree(nodes, tags, path):
+    """
+    What Parser.select must return for path (text), found by walking a decoded tree.
+    """
+    # (node, position if it is a record array element)
+    candidates = [(node, None) for node in nodes if is_record(node)]
+    matches = []
+    for segment in path.strip('/').split('/'):
+        matches = []
+        for node, position in candidates:
+            if position is None:
+                name = tags[node.tag_name_index].decode('ascii')
+            else:
+                name = str(position)
+            if segment == '*' or segment == name:
+                matches.append(node)
+        candidates = []
+        for node in matches:
+            if isinstance(node, RecordArrayNode):
+                candidates.extend((element, i) for i, element in enumerate(node.values))
+            else:
+                records = list(node.children) + [value for value in node.values if is_record(value)]
+                candidates.extend((record, None) for record in records)
+    return matches
+
+
+def array_path(nodes, tags):
+    """
+    Tag path of the first record array, in file order, with more than one element.
+    """
+    stack = [(node, u'') for node in reversed(nodes) if is_record(node)]
+    while stack:
+        node, path = stack.pop()
+        path += u'/' + tags[node.tag_name_index].decode('ascii')
+        if isinstance(node, RecordArrayNode):
+            if len(node.values) > 1:
+                return path
+        else:
+            stack.extend((child, path) for child in reversed(node.children))
+
+
+class SelectTest(TempDirTestCase):
+
+    def test_paths(self):
+        for name in REPLAYS:
+            copy = self.copy_replay(name)
+            parser = parse_file(copy)
+            tags = parser.footer['tags']
+            path = array_path(parser.nodes, tags)
+            self.assertTrue(path, name)
+            for query in (u'root', u'/root/*', path, path + u'/1', path + u'/*', path + u'/0/*',
+                          u'*/*/*', u'root/NO_SUCH_TAG'):
+                expected = canon(select_tree(parser.nodes, tags, query))
+                self.assertEqual(canon(parser.select(query)), expected, (name, query))
+                self.assertEqual(canon(parser.select(query.encode('ascii'))), expected, (name, query))
+                self.assertEqual(canon(select_indexed(copy, query)), expected, (name, query))
+            self.assertTrue(parser.select(path + u'/1'))
+
+
+class ProbeTest(unittest.TestCase):
+
+    def test_header_and_footer(self):
+        for name in REPLAYS:
+            info = probe(replay_path(name))
+            reader = open_reader(replay_path(name))
+            header = Parser.get_header(reader)
+            footer = Parser.get_footer(reader, header)
+            self.assertEqual(info['format'], get_codec(reader).CODEC_NAME)
+            for key in ('magic_number', 'datetime', 'nodes_index'):
+                self.assertEqual(info[key], header[key], key)
+            self.assertEqual(info['tags'], footer['tags'])
+            self.assertEqual(info['ex_values'], footer.get('ex_values', {}))
+
+    def test_unknown_format(self):
+        self.assertRaises(UnknownReplayFileError, probe, replay_path('rome.rpy'))
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_errors_are_isolated(self):
+        paths = [replay_path(name) for name in ('empire.replay', 'rome.rpy', 'napoleon.replay')]
+        for jobs in (1, 2):
+            results = dict((result.path, result) for result in parse_many(paths, jobs=jobs))
+            self.assertEqual(sorted(results), sorted(paths))
+            self.assertFalse(results[paths[1]].ok)
+            self.assertTrue('UnknownReplayFileError' in results[paths[1]].error)
+            for path in paths[0], paths[2]:
+                self.assertTrue(results[path].ok, results[path].error)
+                self.assertEqual(results[path].value['nodes'], len(parse_file(path).nodes))
+
+
+class ParallelParserTest(CorpusTestCase):
+
+    def test_corpus(self):
+        self.check_corpus(lambda path: parse_file(path, lambda reader, codec: ParallelParser(reader, codec, jobs=2)).nodes)
+
+    def test_caller_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            parse = lambda reader, codec: ParallelParser(reader, codec, jobs=2, pool=pool)
+            # twice, so that the workers switch between files they have open
+            for attempt in range(2):
+                self.check_corpus(lambda path: parse_file(path, parse).nodes)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_in_memory_reader(self):
+        with open(replay_path('empire.replay'), 'rb') as fp:
+            reader = BinaryReader(io.BytesIO(fp.read()))
+        self.assertRaises(ValueError, ParallelParser, reader, get_codec(reader))
+
+
+class ParseCacheTest(SyntheticTestCase, TempDirTestCase):
+
+    def parse(self, cache, path):
+        snapshot = cache.parse(path)
+        self.addCleanup(snapshot.close)
+        self.assertTrue(isinstance(snapshot, Snapshot))
+        return snapshot
+
+    def test_cold_and_warm(self):
+        cache = ParseCache(os.path.join(self.tmp, 'cache'))
+        for name in REPLAYS:
+            self.assertEqual(canon(self.parse(cache, replay_path(name)).nodes), expected_tree(name), name + ', cold')
+            self.assertEqual(canon(self.parse(cache, replay_path(name)).nodes), expected_tree(name), name + ', warm')
+
+    def test_deep_records(self):
+        depth = 5000
+        end = self.BODY_START + 8 * depth + 2
+        body = struct.pack('<BHBI', TypeCodes.RECODE, 1, 0, end) * depth + struct.pack('<Bb', TypeCodes.INT8, -1)
+        path = os.path.join(self.tmp, 'deep.replay')
+        with open(path, 'wb') as fp:
+            fp.write(self.replay(body))
+        cache = ParseCache(os.path.join(self.tmp, 'cache'))
+        for attempt in ('cold', 'warm'):
+            node = self.parse(cache, path).nodes[0]
+            levels = 0
+            while node.children:
+                node = node.children[0]
+                levels += 1
+            self.assertEqual(levels, depth, attempt)
+            self.assertEqual(node.values, [-1], attempt)
+
+    def test_threads(self):
+        path = replay_path('empire.replay')
+        cache = ParseCache(os.path.join(self.tmp, 'cache'))
+        key = cache.get_key(path)
+        reader = open_reader(path)
+        tree = parse_flat(reader, get_codec(reader))
+        errors = []
+
+        def work():
+            try:
+                for i in range(10):
+                    # a write of the entry while other threads write and read it
+                    cache.save(key, tree).close()
+                    snapshot = cache.parse(path)
+                    try:
+                        self.assertEqual(len(snapshot), len(tree))
+                    finally:
+                        snapshot.close()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(cache.directory), [key + cache.SUFFIX])
+
+    def test_damaged_entries(self):
+        path = replay_path('empire.replay')
+        cache = ParseCache(os.path.join(self.tmp, 'cache'))
+        self.parse(cache, path)
+        entry = cache.get_path(cache.get_key(path))
+        with open(entry, 'rb') as fp:
+            data = fp.read()
+        # empty, a short header, and a header whose columns are cut off
+        for size in (0, 10, len(data) // 2):
+            with open(entry, 'wb') as fp:
+                fp.write(data[:size])
+            self.assertEqual(cache.load(cache.get_key(path)), None, size)
+            self.assertEqual(canon(self.parse(cache, path).nodes), expected_tree('empire.replay'), size)
+
+    def test_eviction(self):
+        cache = ParseCache(os.path.join(self.tmp, 'cache'), max_size=0)
+        for name in REPLAYS:
+            self.assertEqual(canon(self.parse(cache, replay_path(name)).nodes), expected_tree(name), name)
+            # only the entry just written is left, however large
+            key = cache.get_key(replay_path(name))
+            self.assertEqual(os.listdir(cache.directory), [key + cache.SUFFIX], name)
+
+
+class SnapshotTest(TempDirTestCase):
+
+    def test_corpus(self):
+        for name in REPLAYS:
+            path = os.path.join(self.tmp, name + '.twrs')
+            save_snapshot(parse_file(replay_path(name)), path)
+            snapshot = load_snapshot(path)
+            try:
+                self.assertEqual(canon(snapshot.nodes), expected_tree(name), name)
+            finally:
+                snapshot.close()
+
+
+def json_tree(value, tags):
+    """
+    What the serializer must write for value, as json.loads returns it.
+    """
+    if isinstance(value, (RecordNode, RecordArrayNode, ChildNode)):
+        item = {}
+        if not isinstance(value, ChildNode):
+            item['tag'] = tags[value.tag_name_index].decode('latin-1')
+            item['version'] = value.version
+        if not isinstance(value, RecordArrayNode):
+            item['children'] = [json_tree(child, tags) for child in value.children]
+        item['values'] = [json_tree(child, tags) for child in value.values]
+        return {'__class__': value.__class__.__name__, '__value__': item}
+    elif isinstance(value, (list, tuple)):
+        return [json_tree(item, tags) for item in value]
+    elif isinstance(value, bytes):
+        return value.decode('latin-1')
+    elif isinstance(value, float):
+        return repr(value)
+    elif value is None or isinstance(value, (bool, int, type(2 ** 64), type(u''))):
+        return value
+    return None
+
+
+def json_canon(value):
+    if isinstance(value, dict):
+        return dict((key, json_canon(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return [json_canon(item) for item in value]
+    elif isinstance(value, float):
+        return repr(value)
+    return value
+
+
+class SerializerTest(unittest.TestCase):
+
+    def test_dump(self):
+        for name in REPLAYS:
+            parser = parse_file(replay_path(name))
+            tags = parser.footer['tags']
+            fp = Output()
+            dump(parser.nodes, fp, tags)
+            self.assertEqual(json_canon(json.loads(fp.getvalue())), json_tree(parser.nodes, tags), name)
+
+    def test_dump_ndjson(self):
+        parser = parse_file(replay_path('napoleon.replay'))
+        tags = parser.footer['tags']
+        expected = []
+        stack = [(node, []) for node in reversed(parser.nodes)]
+        while stack:
+            node, path = stack.pop()
+            path = path + [tags[node.tag_name_index].decode('latin-1')]
+            if isinstance(node, RecordNode):
+                if node.values:
+                    expected.append({'path': path, 'version': node.version,
+                                     'values': json_tree(node.values, tags)})
+                stack.extend((child, path) for child in reversed(node.children))
+            else:
+                for i, element in enumerate(node.values):
+                    expected.append({'path': path, 'version': node.version, 'element': i,
+                                     'values': json_tree(element.values, tags)})
+        fp = Output()
+        dump_ndjson(parser.nodes, fp, tags)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(len(lines), len(expected))
+        for line, item in zip(lines, expected):
+            self.assertEqual(json_canon(json.loads(line)), item)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def report(self, parser_name, mb_per_s):
+        return {'parser': parser_name, 'results': [{'file': 'empire.replay', 'status': 'ok', 'mb_per_s': mb_per_s}]}
+
+    def test_compare(self):
+        baseline = self.report('Parser', 10.0)
+        self.assertEqual(compare(self.report('Parser', 9.5), baseline), [])
+        self.assertEqual(compare(self.report('Parser', 5.0), baseline), [('empire.replay', 'mb_per_s', 10.0, 5.0)])
+
+    def test_other_parser(self):
+        self.assertRaises(ValueError, compare, self.report('StackParser', 10.0), self.report('Parser', 10.0))
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_counts(self):
+        reader = open_reader(replay_path('napoleon.replay'))
+        profile = DecodeProfile()
+        parser = Parser(reader, get_codec(reader), profile=profile)
+        self.assertEqual(canon(parser.nodes), expected_tree('napoleon.replay'))
+        nodes = list(walk(parser.nodes))
+        records = len([node for node in nodes if isinstance(node, RecordNode)])
+        arrays = len([node for node in nodes if isinstance(node, RecordArrayNode)])
+        self.assertEqual(profile.type_stats[TypeCodes.RECODE][0], records)
+        self.assertEqual(profile.type_stats[TypeCodes.RECODE_ARRAY][0], arrays)
+        self.assertEqual(sum(stats[0] for stats in profile.tag_stats.values()), records + arrays)
+
+    def test_tag_names(self):
+        reader = open_reader(replay_path('napoleon.replay'))
+        profile = DecodeProfile()
+        Parser(reader, get_codec(reader), profile=profile)
+        self.assertTrue(u'BATTLE_REPLAY' in profile.tag_stats)
+        fp = Output()
+        profile.write_collapsed(fp)
+        lines = fp.getvalue().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertEqual(stack.split(';')[0], u'root', line)
+            self.assertTrue(int(count) >= 0)
+        self.assertTrue(u'\nBATTLE_REPLAY ' in profile.report(limit=1000))
+
+    def test_unsupported_parsers(self):
+        reader = open_reader(replay_path('empire.replay'))
+        # each would leave values out of the profile
+        for parser_class in (StackParser, ParallelParser, LazyParser):
+            self.assertRaises(ValueError, parser_class, reader, get_codec(reader), profile=DecodeProfile())
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_columns_match_tree(self):
+        parser = parse_file(replay_path('empire.replay'))
+        tags = parser.footer['tags']
+        root = parser.nodes[0]
+        arrays = [child for child in root.children if isinstance(child, RecordArrayNode) and child.values]
+        for array in arrays:
+            path = b'root/' + tags[array.tag_name_index]
+            columns = [columns for columns in select_columns(parser, path) if len(columns) == len(array.values)][0]
+            for i, element in enumerate(array.values):
+                values = [value for value in element.values if not is_record(value)]
+                if not element.children and len(values) == len(columns.columns):
+                    self.assertEqual(canon([list(column)[i] for column in columns.columns]), canon(values))
+
+    def test_missing_fields(self):
+        columns = RecordColumns(0, 0)
+        columns.add_element([TypeCodes.INT32], [1])
+        columns.add_element([TypeCodes.INT32, TypeCodes.INT32], [2, 3])
+        columns.add_element([TypeCodes.INT32], [4])
+        self.assertEqual(columns.type_codes, [TypeCodes.INT32, None])
+        self.assertEqual([list(column) for column in columns.columns], [[1, 2, 4], [None, 3, None]])
+
+
+class FlatTreeTest(CorpusTestCase):
+
+    def test_parse_flat(self):
+        def parse(path):
+            reader = open_reader(path)
+            return parse_flat(reader, get_codec(reader)).nodes
+        self.check_corpus(parse)
+
+    def test_from_parser(self):
+        self.check_corpus(lambda path: from_parser(parse_file(path)).nodes)
+
+
+class NodeSlotsTest(unittest.TestCase):
+
+    def test_nodes(self):
+        parser = parse_file(replay_path('empire.replay'))
+        for node in walk(parser.nodes):
+            self.assertFalse(hasattr(node, '__dict__'))
+            if not isinstance(node, ChildNode):
+                self.assertEqual((node.reader, node.codec, node.parser), (None, None, None))
+        self.assertEqual(canon(pickle.loads(pickle.dumps(parser.nodes, 2))), expected_tree('empire.replay'))
+
+
+class StringTest(SyntheticTestCase, TempDirTestCase):
+
+    def test_ca_strings(self):
+        strings = [u'caf\xe9', u'\U0001f600', u'a\ud800b', u'']
+        body = b''
+        for value in strings + strings[:1]:
+            units = value.encode('utf-16-le', 'surrogatepass') if str is not bytes else value.encode('utf-16-le')
+            body += struct.pack('<BH', TypeCodes.UTF16, len(units) // 2) + units
+        body += struct.pack('<BH', TypeCodes.ASCII, 3) + b'ab\xff' + struct.pack('<BH', TypeCodes.ASCII, 3) + b'ab\xff'
+        # one value per UTF-16 code unit; a non-BMP character is kept as its surrogate pair
+        expected = [u'caf\xe9', u'\ud83d\ude00', u'a\ud800b', u'', u'caf\xe9', b'ab\xff', b'ab\xff']
+        self.check_parsers(self.replay(body), [('record', 0, 1, self.BODY_START + len(body), [], expected)])
+        parser = parse_bytes(self.replay(body))
+        values = parser.nodes[0].values
+        self.assertTrue(values[0] is values[4])
+        self.assertTrue(values[5] is values[6])
+
+        path = os.path.join(self.tmp, 'strings.twrs')
+        save_snapshot(parser, path)
+        snapshot = load_snapshot(path)
+        try:
+            self.assertEqual(canon(snapshot.nodes[0].values), expected)
+        finally:
+            snapshot.close()
+
+
+class SharedCodecTest(unittest.TestCase):
+
+    def test_codec_is_not_changed(self):
+        reader = open_reader(replay_path('napoleon.replay'))
+        codec = get_codec(reader)
+        Parser(reader, codec)
+        self.assertEqual((codec.HEADER, codec.FOOTER, codec.decoders), (None, None, None))
+
+    def test_threads(self):
+        names = ['empire.replay', 'napoleon.replay']
+        codec = get_codec(open_reader(replay_path(names[0])))
+        for name in names:
+            expected_tree(name)
+        errors = []
+
+        def work(name):
+            try:
+                with open(replay_path(name), 'rb') as fp:
+                    data = fp.read()
+                for i in range(2):
+                    reader = BinaryReader(io.BytesIO(data))
+                    if canon(Parser(reader, codec).nodes) != expected_tree(name):
+                        errors.append(name)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(names[i % 2],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+try:
+    import asyncio
+    import concurrent.futures
+    import twrpy.aio as aio
+except (ImportError, SyntaxError):
+    # Python 2
+    aio = None
+
+# [running, highest] number of handlers running at once
+_handlers = [0, 0]
+_handlers_lock = threading.Lock()
+
+
+def count_handlers(parser):
+    with _handlers_lock:
+        _handlers[0] += 1
+        _handlers[1] = max(_handlers)
+    time.sleep(0.02)
+    with _handlers_lock:
+        _handlers[0] -= 1
+    return len(parser.nodes)
+
+
+@unittest.skipIf(aio is None, 'asyncio needs Python 3')
+class AioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_aparse(self):
+        parser = self.loop.run_until_complete(aio.aparse(replay_path('napoleon.replay')))
+        self.assertEqual(canon(parser.nodes), expected_tree('napoleon.replay'))
+
+    def test_process_pool(self):
+        executor = concurrent.futures.ProcessPoolExecutor(2)
+        try:
+            for parser_class in (Parser, LazyParser):
+                parser = self.loop.run_until_complete(
+                    aio.aparse(replay_path('napoleon.replay'), parser_class, executor=executor))
+                self.assertEqual(canon(parser.nodes), expected_tree('napoleon.replay'), parser_class.__name__)
+                self.assertEqual((parser.reader, parser.codec), (None, None))
+        finally:
+            executor.shutdown()
+
+    def test_aparse_many(self):
+        paths = [replay_path(name) for name in ('empire.replay', 'rome.rpy', 'napoleon.replay', 'shogun2.replay')] * 2
+        taken = []
+
+        def iter_paths():
+            for path in paths:
+                taken.append(path)
+                yield path
+
+        jobs = 2
+        executor = concurrent.futures.ThreadPoolExecutor(len(paths))
+        results = []
+        try:
+            results_iter = aio.aparse_many(iter_paths(), jobs=jobs, handler=count_handlers, executor=executor)
+            while True:
+                try:
+                    results.append(self.loop.run_until_complete(results_iter.__anext__()))
+                except StopAsyncIteration:
+                    break
+                self.assertTrue(len(taken) <= len(results) + jobs)
+        finally:
+            executor.shutdown()
+        self.assertEqual(sorted(result.path for result in results), sorted(paths))
+        self.assertTrue(1 <= _handlers[1] <= jobs)
+        for result in results:
+            self.assertEqual(result.ok, not result.path.endswith('.rpy'))
+
+
+class PackedCodeTest(SyntheticTestCase):
+
+    def test_values_and_arrays(self):
+        body = b''
+        for code, payload in [(TypeCodes.BOOL_TRUE, b''), (TypeCodes.BOOL_FALSE, b''),
+                              (TypeCodes.UINT32_ZERO, b''), (TypeCodes.UINT32_ONE, b''),
+                              (TypeCodes.UINT32_BYTE, b'\xfe'), (TypeCodes.UINT32_SHORT, struct.pack('<H', 65000)),
+                              (TypeCodes.UINT32_24BIT, b'\x12\x34\x56'), (TypeCodes.INT32_ZERO, b''),
+                              (TypeCodes.INT32_BYTE, b'\xfe'), (TypeCodes.INT32_SHORT, struct.pack('<h', -300)),
+                              (TypeCodes.INT32_24BIT, b'\x80\x00\x05'), (TypeCodes.FLOAT32_ZERO, b'')]:
+            body += struct.pack('<B', code) + payload
+        for code, payload in [(TypeCodes.UINT32_BYTE_ARRAY, b'\x01\xff'),
+                              (TypeCodes.UINT32_SHORT_ARRAY, struct.pack('<3H', 1, 2, 60000)),
+                              (TypeCodes.UINT32_24BIT_ARRAY, b'\x00\x00\x01\xff\xff\xff\x01\x00\x00'),
+                              (TypeCodes.INT32_BYTE_ARRAY, b'\x80\x7f'),
+                              (TypeCodes.INT32_SHORT_ARRAY, struct.pack('<2h', -1, 5)),
+                              (TypeCodes.INT32_24BIT_ARRAY, b'\x80\x00\x01\x00\x00\x02\xff\xff\xff'),
+                              (TypeCodes.BOOL_TRUE_ARRAY, b'\x00\x00'),
+                              (TypeCodes.BOOL_FALSE_ARRAY, b'\x01')]:
+            body += struct.pack('<BI', code, self.BODY_START + len(body) + 5 + len(payload)) + payload
+        values = [True, False, 0, 1, 254, 65000, 0x123456, 0, -2, -300, -5, repr(0.0),
+                  [1, 255], [1, 2, 60000], [1, 0xffffff, 0x10000], [-128, 127], [-1, 5],
+                  [-1, 2, -0x7fffff], [True, True], [False]]
+        self.check_parsers(self.replay(body), [('record', 0, 1, self.BODY_START + len(body), [], values)])
+
+    def test_constant_arrays(self):
+        # their layout is unconfirmed, so they are rejected rather than decoded to a guessed length
+        for code in (TypeCodes.UINT_ZERO_ARRAY, TypeCodes.UINT_ONE_ARRAY, TypeCodes.INT32_ZERO_ARRAY,
+                     TypeCodes.SINGLE_ZERO_ARRAY):
+            data = self.replay(struct.pack('<BI', code, self.BODY_START + 5 + 2) + b'\x00\x00')
+            for parser_class in PARSERS:
+                # LazyParser decodes the root's values when they are read
+                self.assertRaises(InvalidDataStructureError, lambda: canon(parse_bytes(data, parser_class).nodes))
+
+
+class AbcaTest(SyntheticTestCase):
+
+    def uintvar(self, value):
+        data = [value & 0x7f]
+        value >>= 7
+        while value:
+            data.append(0x80 | (value & 0x7f))
+            value >>= 7
+        return struct.pack('%dB' % len(data), *reversed(data))
+
+    def replay(self, body):
+        """
+        ABCA replay whose root record (tag 0, version 1) holds body; tag 1 is ITEM and
+        ex_values[5] is u'hi'. The footer takes the last 28 bytes.
+        """
+        root = struct.pack('<BHB', 0x80, 0, 1) + self.uintvar(len(body)) + body
+        footer = struct.pack('<H', 2) + struct.pack('<H', 4) + b'root' + struct.pack('<H', 4) + b'ITEM'
+        footer += struct.pack('<HH', 1, 0) + struct.pack('<H', 2) + u'hi'.encode('utf-16-le') + struct.pack('<I', 5)
+        return struct.pack('<IIII', 0xABCA, 0, 0, 16 + len(root)) + root + footer
+
+    def test_uintvar_sizes(self):
+        uintvar = self.uintvar
+        # root record: 0x80 with the long header, then a uintvar size of at least 128
+        ints = list(range(-20, 20))
+        int_array = struct.pack('<%di' % len(ints), *ints)
+        body = struct.pack('<B', TypeCodes.INT32_ARRAY) + uintvar(len(int_array)) + int_array
+        body += struct.pack('<BI', TypeCodes.UTF16, 5)
+        # record array with the short header (tag 1, version 2); its element holds a value
+        # and a record with the short header (tag 1, version 3)
+        nested_body = struct.pack('<BB', TypeCodes.UINT8, 9)
+        nested = struct.pack('<BB', 0x80 | (3 << 1), 1) + uintvar(len(nested_body)) + nested_body
+        element = struct.pack('<BB', TypeCodes.UINT8, 4) + nested
+        array = uintvar(len(element)) + element
+        body += struct.pack('<BB', 0xc0 | (2 << 1), 1) + uintvar(len(array)) + uintvar(1) + array
+        self.assertTrue(len(body) >= 128)
+        data = self.replay(body)
+
+        end = len(data) - 28
+        expected = [('record', 0, 1, end, [
+            ('array', 1, 2, end, 1, [
+                ('element', [], [4, ('record', 1, 3, end, [], [9])])])], [ints, u'hi'])]
+        self.check_parsers(data, expected)
+        parser = parse_bytes(data)
+        self.assertEqual(parser.footer['tags'], [b'root', b'ITEM'])
+        # the accessors of older callers return the decoded header
+        array = parser.nodes[0].children[0]
+        record = array.values[0].values[1]
+        self.assertEqual((array.get_tag_name_index(), array.get_version(), array.get_elements_length()), (1, 2, 1))
+        self.assertEqual((record.get_tag_name_index(), record.get_version()), (1, 3))
+
+    def test_packed_layouts(self):
+        uintvar = self.uintvar
+        # one ITEM array whose uint32 and bool fields use a different packing in each element
+        elements = [struct.pack('<BB', TypeCodes.UINT32_ZERO, TypeCodes.BOOL_TRUE),
+                    struct.pack('<BBB', TypeCodes.UINT32_BYTE, 200, TypeCodes.BOOL_FALSE),
+                    struct.pack('<BIBB', TypeCodes.UINT32, 70000, TypeCodes.BOOL, 1)]
+        array = b''.join(uintvar(len(element)) + element for element in elements)
+        body = struct.pack('<BB', 0xc0, 1) + uintvar(len(array)) + uintvar(len(elements)) + array
+        data = self.replay(body)
+
+        end = len(data) - 28
+        expected = [('record', 0, 1, end, [
+            ('array', 1, 0, end, 3, [('element', [], [0, True]), ('element', [], [200, False]),
+                                     ('element', [], [70000, True])])], [])]
+        self.check_parsers(data, expected)
+
+        columns = select_columns(parse_bytes(data), 'root/ITEM')[0]
+        self.assertEqual(columns.type_codes, [TypeCodes.UINT32, TypeCodes.BOOL])
+        self.assertEqual(list(columns[0]), [0, 200, 70000])
+        self.assertEqual([bool(value) for value in columns[1]], [True, False, True])
+
+
+class RecordArrayElementTest(SyntheticTestCase):
+
+    def test_nested_records(self):
+        # ABCE: an element holding a value and a nested record, which stays in its values
+        array_start = self.BODY_START + 12
+        value = struct.pack('<BH', TypeCodes.UINT16, 7)
+        nested_body = struct.pack('<Bb', TypeCodes.INT8, -3)
+        nested_end = array_start + 4 + len(value) + 8 + len(nested_body)
+        element = value + struct.pack('<BHBI', TypeCodes.RECODE, 1, 0, nested_end) + nested_body
+        element = struct.pack('<I', array_start + 4 + len(element)) + element
+        array_end = array_start + len(element)
+        body = struct.pack('<BHBII', TypeCodes.RECODE_ARRAY, 1, 2, array_end, 1) + element
+        expected = [('record', 0, 1, array_end, [
+            ('array', 1, 2, array_end, 1, [
+                ('element', [], [7, ('record', 1, 0, array_end, [], [-3])])])], [])]
+        self.check_parsers(self.replay(body), expected)
+
+    def test_corpus(self):
+        parser = parse_file(replay_path('empire.replay'))
+        records = 0
+        for node in walk(parser.nodes):
+            if isinstance(node, ChildNode):
+                self.assertEqual(node.children, [])
+                records += len([value for value in node.values if is_record(value)])
+        self.assertTrue(records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+asyncio front end: decoding runs in an executor so the event loop keeps serving other work.
+
+Needs Python 3.6 or later (async generators). Import twrpy.aio directly; the package does
+not load it, so Python 2 and python -m twrpy.batch never see it.
+"""
+
+import asyncio
+
+from twrpy.batch import parse_file, summarize
+from twrpy.codecs import get_codec
+from twrpy.parser import Parser
+from twrpy.reader import BinaryReader
+
+_done = object()
+
+
+def load(path, parser_class=Parser):
+    """
+    Parse path in memory; the returned parser keeps no file open.
+    From a process pool it comes back pickled, without its reader and codec.
+    """
+    with open(path, 'rb') as fp:
+        reader = BinaryReader(fp)
+    return parser_class(reader, get_codec(reader))
+
+
+async def aparse(path, parser_class=Parser, executor=None, semaphore=None):
+    """
+    await aparse(path) -> decoded parser.
+
+    executor is a concurrent.futures executor, the loop's default thread pool when None. Decoding
+    is pure Python, so threads only keep the loop responsive; use a ProcessPoolExecutor to decode
+    on several cores. The parser then comes back pickled: header, footer and nodes, with reader
+    and codec set to None, so select cannot be used on it. A shared asyncio.Semaphore bounds how
+    many parses run at once across callers. Cancelling the await drops a parse that has not
+    started yet; one already running in a thread finishes and its result is discarded.
+    """
+    # inside a coroutine this is the running loop; get_running_loop needs 3.7
+    loop = asyncio.get_event_loop()
+    if semaphore is None:
+        return await loop.run_in_executor(executor, load, path, parser_class)
+    async with semaphore:
+        return await loop.run_in_executor(executor, load, path, parser_class)
+
+
+async def aparse_many(paths, jobs=4, handler=summarize, parser_class=Parser, executor=None):
+    """
+    Async iterator of BatchResult objects as files finish, like batch.parse_many.
+
+    At most jobs files are in flight, and the next path is only taken from paths once a result
+    has been handed to the consumer, so a slow consumer or a long (even endless) paths iterator
+    does not queue work without bound. handler runs in the executor; with a process pool it must
+    be picklable. Closing the iterator early or cancelling the consuming task cancels the files
+    that have not started.
+    """
+    # inside a coroutine this is the running loop; get_running_loop needs 3.7
+    loop = asyncio.get_event_loop()
+    paths = iter(paths)
+    pending = set()
+    try:
+        while True:
+            while len(pending) < jobs:
+                path = next(paths, _done)
+                if path is _done:
+                    break
+                pending.add(loop.run_in_executor(executor, parse_file, path, handler, parser_class))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import sys
+import time
+import traceback
+
+from twrpy.codecs import get_codec
+from twrpy.parser import Parser
+from twrpy.reader import MappedBinaryReader
+
+
+class BatchResult:
+    """
+    Outcome of one file: value is what the handler returned, error the formatted traceback if it failed.
+    """
+
+    def __init__(self, path, value=None, error=None, elapsed=0.0):
+        self.path = path
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def summarize(parser):
+    """
+    Default handler: header, footer and number of top-level nodes.
+    """
+    return {
+        'header': parser.header,
+        'footer': parser.footer,
+        'nodes': len(parser.nodes),
+    }
+
+
+def parse_file(path, handler=summarize, parser_class=Parser):
+    """
+    Parse one replay and run handler(parser) on it.
+    Any exception is caught and returned in the result so one broken file does not stop a batch.
+    """
+    start = time.time()
+    try:
+        fp = open(path, 'rb')
+        try:
+            reader = MappedBinaryReader(fp)
+            try:
+                codec = get_codec(reader)
+                value = handler(parser_class(reader, codec))
+            finally:
+                reader.close()
+        finally:
+            fp.close()
+    except Exception:
+        return BatchResult(path, error=traceback.format_exc(), elapsed=time.time() - start)
+    return BatchResult(path, value=value, elapsed=time.time() - start)
+
+
+def _parse_task(task):
+    return parse_file(*task)
+
+
+def parse_many(paths, jobs=None, handler=summarize, parser_class=Parser, chunksize=None):
+    """
+    Parse replays across a process pool, yielding BatchResult objects as files finish.
+    handler runs in the worker and must be picklable (a module-level function); its return value
+    is sent back instead of the node tree.
+    """
+    paths = list(paths)
+    tasks = [(path, handler, parser_class) for path in paths]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1:
+        for task in tasks:
+            yield _parse_task(task)
+        return
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (jobs * 4))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(_parse_task, tasks, chunksize):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    import argparse
+    argparser = argparse.ArgumentParser(description='Parse Total War replay files in parallel.')
+    argparser.add_argument('paths', nargs='+', help='replay files')
+    argparser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: cpu count)')
+    argparser.add_argument('--chunksize', type=int, default=None, help='files handed to a worker at a time')
+    args = argparser.parse_args(argv)
+
+    failures = 0
+    for result in parse_many(args.paths, jobs=args.jobs, chunksize=args.chunksize):
+        if result.ok:
+            print('%s\tok\t%.3fs\t%d nodes' % (result.path, result.elapsed, result.value['nodes']))
+        else:
+            failures += 1
+            print('%s\terror\t%.3fs\t%s' % (result.path, result.elapsed, result.error.strip().splitlines()[-1]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
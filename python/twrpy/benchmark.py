@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+from twrpy import parser as parser_module
+from twrpy.codecs import get_codec
+from twrpy.errors import UnknownReplayFileError
+from twrpy.nodes import RecordNode, RecordArrayNode, ChildNode
+from twrpy.reader import BinaryReader
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TESTDATA = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'testdata'))
+
+# metrics compared against a baseline; higher is better
+THROUGHPUT_METRICS = ('mb_per_s', 'nodes_per_s', 'records_per_s')
+
+
+def count_nodes(nodes):
+    """
+    (nodes, records) below nodes; record array elements count as nodes, not records.
+    """
+    total = 0
+    records = 0
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        total += 1
+        if isinstance(node, RecordNode):
+            records += 1
+            stack.extend(node.children)
+            stack.extend(node.values)
+        elif isinstance(node, RecordArrayNode):
+            records += 1
+            stack.extend(node.values)
+        elif isinstance(node, ChildNode):
+            stack.extend(node.children)
+            stack.extend(node.values)
+    return total, records
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in KiB, None where unavailable.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def parse(path, parser_class):
+    fp = open(path, 'rb')
+    try:
+        reader = BinaryReader(fp)
+        return parser_class(reader, get_codec(reader))
+    finally:
+        fp.close()
+
+
+def time_phases(path, parser_class):
+    """
+    Seconds spent in the header, footer and body of one parse.
+    The header and footer are timed on their own; body is the rest of the parse
+    (decoder tables and nodes).
+    """
+    fp = open(path, 'rb')
+    try:
+        reader = BinaryReader(fp)
+        codec = get_codec(reader)
+        start = time.time()
+        header = parser_class.get_header(reader)
+        header_time = time.time() - start
+        start = time.time()
+        parser_class.get_footer(reader, header)
+        footer_time = time.time() - start
+        start = time.time()
+        parser = parser_class(reader, codec)
+        total = time.time() - start
+    finally:
+        fp.close()
+    return {
+        'header': header_time,
+        'footer': footer_time,
+        'body': max(0.0, total - header_time - footer_time),
+    }, parser
+
+
+def benchmark_file(path, parser_class=parser_module.Parser, repeat=3):
+    """
+    Measure one replay. Phase times are the best of repeat runs; memory is measured
+    in an extra run under tracemalloc (Python 3 only) after peak RSS has been read.
+    """
+    result = {
+        'file': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'parser': parser_class.__name__,
+    }
+    try:
+        best = None
+        for i in range(repeat):
+            phases, parser = time_phases(path, parser_class)
+            if best is None or sum(phases.values()) < sum(best.values()):
+                best = phases
+    except UnknownReplayFileError as e:
+        result['status'] = 'unsupported'
+        result['error'] = str(e)
+        return result
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        return result
+
+    nodes, records = count_nodes(parser.nodes)
+    del parser
+    total = sum(best.values())
+    result.update({
+        'status': 'ok',
+        'nodes': nodes,
+        'records': records,
+        'phases': best,
+        'seconds': total,
+        'mb_per_s': result['size'] / total / 1e6 if total else None,
+        'nodes_per_s': nodes / total if total else None,
+        'records_per_s': records / total if total else None,
+        'peak_rss_kb': peak_rss(),
+        'tracemalloc_peak': None,
+    })
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            parse(path, parser_class)
+            result['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _benchmark_task(task):
+    path, parser_name, repeat = task
+    return benchmark_file(path, getattr(parser_module, parser_name), repeat)
+
+
+def run(paths, parser_name='Parser', repeat=3, isolate=True):
+    """
+    Benchmark every path. With isolate, each file runs in a fresh process so that
+    peak RSS belongs to that file alone.
+    """
+    results = []
+    for path in paths:
+        task = (path, parser_name, repeat)
+        if isolate:
+            pool = multiprocessing.Pool(1)
+            try:
+                results.append(pool.apply(_benchmark_task, (task,)))
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            results.append(_benchmark_task(task))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'parser': parser_name,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    (file, metric, baseline value, value) for every throughput metric that fell more
+    than tolerance below the baseline. Files missing from either side are ignored.
+    Raises ValueError if the baseline was measured with another parser class.
+    """
+    if baseline.get('parser') != report['parser']:
+        raise ValueError('Baseline was measured with %s, not %s.' % (baseline.get('parser'), report['parser']))
+    previous = dict((result['file'], result) for result in baseline['results'] if result.get('status') == 'ok')
+    regressions = []
+    for result in report['results']:
+        if result.get('status') != 'ok' or result['file'] not in previous:
+            continue
+        for metric in THROUGHPUT_METRICS:
+            expected = previous[result['file']].get(metric)
+            value = result.get(metric)
+            if expected and value is not None and value < expected * (1 - tolerance):
+                regressions.append((result['file'], metric, expected, value))
+    return regressions
+
+
+def default_paths():
+    return sorted(os.path.join(TESTDATA, name) for name in os.listdir(TESTDATA))
+
+
+def main(argv=None):
+    import argparse
+    argparser = argparse.ArgumentParser(description='Benchmark the replay parser.')
+    argparser.add_argument('paths', nargs='*', help='replay files (default: every file in testdata)')
+    argparser.add_argument('-o', '--output', help='write the report as JSON to this file')
+    argparser.add_argument('-b', '--baseline', help='JSON report to compare against')
+    argparser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                           help='allowed throughput drop against the baseline (default: 0.1)')
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help='runs per file, the best is kept')
+    argparser.add_argument('-p', '--parser', default='Parser', help='parser class in twrpy.parser')
+    argparser.add_argument('--no-isolate', action='store_true', help='run every file in this process')
+    args = argparser.parse_args(argv)
+
+    report = run(args.paths or default_paths(), args.parser, args.repeat, not args.no_isolate)
+    for result in report['results']:
+        if result['status'] != 'ok':
+            print('%s\t%s\t%s' % (result['file'], result['status'], result['error']))
+            continue
+        phases = result['phases']
+        print('%s\t%.2f MB/s\t%d nodes/s\t%d records/s\theader %.4fs\tfooter %.4fs\tbody %.4fs\trss %s KiB\ttracemalloc %s' % (
+            result['file'], result['mb_per_s'], result['nodes_per_s'], result['records_per_s'],
+            phases['header'], phases['footer'], phases['body'], result['peak_rss_kb'], result['tracemalloc_peak']))
+    if args.output:
+        fp = open(args.output, 'w')
+        try:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+
+    if args.baseline:
+        fp = open(args.baseline)
+        try:
+            baseline = json.load(fp)
+        finally:
+            fp.close()
+        try:
+            regressions = compare(report, baseline, args.tolerance)
+        except ValueError as e:
+            print('error\t%s' % e)
+            return 2
+        for name, metric, expected, value in regressions:
+            print('regression\t%s\t%s\t%.2f -> %.2f' % (name, metric, expected, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
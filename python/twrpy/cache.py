@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import struct
+
+from twrpy.codecs import get_codec
+from twrpy.flat import parse_flat
+from twrpy.parser import Parser, DECODER_VERSION
+from twrpy.reader import MappedBinaryReader
+from twrpy.snapshot import Snapshot, load_snapshot, write_snapshot
+
+
+class ParseCache(object):
+    """
+    On-disk cache of parse results keyed by a hash of the replay contents and DECODER_VERSION.
+
+    Entries are snapshot files (see twrpy.snapshot) written to a temporary file and renamed
+    into place, so concurrent workers can share a directory. parse returns the entry as an
+    open Snapshot: a hit only maps the file, records are read when accessed. The caller
+    closes it. A hit refreshes the entry's mtime; when the directory grows past max_size the
+    least recently used entries are removed, never the one just written.
+    """
+
+    SUFFIX = '.twrs'
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024, parser_class=Parser):
+        self.directory = directory
+        self.max_size = max_size
+        self.parser_class = parser_class
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def get_key(self, path):
+        digest = hashlib.sha1()
+        digest.update(('%s:%d:%d:' % (self.parser_class.__name__, DECODER_VERSION,
+                                      Snapshot.VERSION)).encode('ascii'))
+        fp = open(path, 'rb')
+        try:
+            while True:
+                chunk = fp.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        finally:
+            fp.close()
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            snapshot = load_snapshot(path)
+        except (IOError, OSError, ValueError, struct.error):
+            # missing, truncated, or written by another snapshot version
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return snapshot
+
+    def save(self, key, tree):
+        path = self.get_path(key)
+        write_snapshot(tree, path)
+        snapshot = load_snapshot(path)
+        # mtimes can be too coarse to tell the new entry from older ones, so it is never
+        # evicted here, even if it alone exceeds max_size
+        self.evict(path)
+        return snapshot
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the directory fits in max_size.
+        The entry at path keep is never removed.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            total += stat.st_size
+            if path != keep:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def parse(self, path):
+        key = self.get_key(path)
+        snapshot = self.load(key)
+        if snapshot is not None:
+            return snapshot
+        fp = open(path, 'rb')
+        try:
+            reader = MappedBinaryReader(fp)
+            try:
+                tree = parse_flat(reader, get_codec(reader), self.parser_class)
+            finally:
+                reader.close()
+        finally:
+            fp.close()
+        return self.save(key, tree)
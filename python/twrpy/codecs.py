@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from twrpy.errors import UnknownReplayFileError
+from twrpy.types import TypeCodes
 
 
 class BaseCodec:
@@ -9,16 +10,80 @@ class BaseCodec:
 
     BLOCK_BIT = hex(0)
     CODEC_NAME = 'BASE'
-    HEADER = None
-    FOOTER = None
+    # type code -> TypeCodes.RECODE or TypeCodes.RECODE_ARRAY for record nodes, None for the rest
+    RECORD_KINDS = [None] * 256
+    RECORD_KINDS[TypeCodes.RECODE] = TypeCodes.RECODE
+    RECORD_KINDS[TypeCodes.RECODE_ARRAY] = TypeCodes.RECODE_ARRAY
 
     def __init__(self,):
-        pass
+        self.HEADER = None
+        self.FOOTER = None
+        self.decoders = None # type code -> decode function, built by Parser.get_decoders
+
+    def bind(self, header, footer):
+        """
+        Context for parsing one replay: a new codec of the same class holding its header and footer.
+        Parsers decode through their own bound codec and never change the one they were given,
+        so a codec can be shared by parses running in other threads.
+        """
+        codec = self.__class__()
+        codec.HEADER = header
+        codec.FOOTER = footer
+        return codec
+
+    def read_offset(self, reader):
+        """
+        Offset of first byte after the end of the array node, record or record array element
+        whose size comes next.
+        """
+        return reader.read_uint32_value()
+
+    def read_array_header(self, reader):
+        """
+        (offset of first byte after the end of the record array, number of elements)
+        of the record array whose size comes next.
+        """
+        offset = reader.read_uint32_value()
+        return offset, reader.read_uint32_value()
+
+    def read_record_tag(self, reader, type_code=None):
+        """
+        (tag name index, version) of the record node whose type code was just read.
+        """
+        return reader.read_uint16_value(), reader.read_uint8_value()
 
 
 class CaCodec(BaseCodec):
+    """
+    Sizes are uintvar byte counts from the end of the size, element counts are uintvars;
+    the size of a record array is followed by its element count and counts from the end of it.
+    Every type code with the 0x80 bit is a record, a record array if 0x40 is set too.
+    With 0x20 (and always for the root record) uint16 tag name index and uint8 version follow;
+    otherwise the version is in bits 1-4 of the type code, bit 0 is the top bit of a 9 bit
+    tag name index and one byte holds the rest.
+    """
     CODEC_NAME = 'ABCA'
-    pass
+    BLOCK_BIT = 0x40
+    LONG_INFO = 0x20
+    RECORD_KINDS = [None] * 0x80 + [TypeCodes.RECODE_ARRAY if code & 0x40 else TypeCodes.RECODE
+                                    for code in range(0x80, 0x100)]
+
+    def read_offset(self, reader):
+        size = reader.read_uintvar_value()
+        return reader.index + size
+
+    def read_array_header(self, reader):
+        size = reader.read_uintvar_value()
+        count = reader.read_uintvar_value()
+        return reader.index + size, count
+
+    def read_record_tag(self, reader, type_code=None):
+        start = reader.index - 1
+        if type_code is None:
+            type_code = reader.read_uint8_at(start)
+        if type_code & self.LONG_INFO or start == self.HEADER['nodes_index'][0]:
+            return reader.read_uint16_value(), reader.read_uint8_value()
+        return ((type_code & 1) << 8) | reader.read_uint8_value(), (type_code >> 1) & 0x0f
 
 
 class CeCodec(BaseCodec):
@@ -42,9 +107,9 @@ class RoCodec(BaseCodec):
 def get_codec(reader):
     reader.index = 0
     codec_type = reader.read('uint32', next=True)
+    filename = reader.filename
     if codec_type == 43978: # abca
-        raise UnknownReplayFileError(filename)
-        #codec = CaCodec()
+        codec = CaCodec()
     elif codec_type == 43982: # abce
         codec = CeCodec()
     elif codec_type == 43983: # abcf
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+
+from twrpy.types import TypeCodes, PACKED_TYPES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# type code -> (array.array typecode, numpy dtype) for single value fields
+FIELD_TYPES = {
+    TypeCodes.BOOL: ('B', 'bool'),
+    TypeCodes.INT8: ('b', 'int8'),
+    TypeCodes.INT16: ('h', 'int16'),
+    TypeCodes.INT32: ('i', 'int32'),
+    TypeCodes.INT64: ('q', 'int64'),
+    TypeCodes.UINT8: ('B', 'uint8'),
+    TypeCodes.UINT16: ('H', 'uint16'),
+    TypeCodes.UINT32: ('I', 'uint32'),
+    TypeCodes.UINT64: ('Q', 'uint64'),
+    TypeCodes.FLOAT32: ('f', 'float32'),
+    TypeCodes.FLOAT64: ('d', 'float64'),
+    TypeCodes.ANGLE: ('H', 'uint16'),
+}
+
+
+def new_column(type_code):
+    """
+    Empty array.array for a field, or a list when the type has no array typecode
+    (strings, coordinates, arrays, records, 64 bit integers on Python 2).
+    """
+    field_type = FIELD_TYPES.get(type_code)
+    if field_type is None:
+        return []
+    try:
+        return array.array(field_type[0])
+    except ValueError:
+        return []
+
+
+class RecordColumns(object):
+    """
+    Elements of one record array as columns: columns[i] holds value i of every element.
+    type_codes[i] is the type code of the field, None when elements disagree. Packed codes are
+    given as their type (PACKED_TYPES) and records as RECODE or RECODE_ARRAY, so an ABCA field
+    stays typed whatever packing each value got. Fields that are missing from some elements
+    or change type are kept as lists, padded with None.
+    """
+
+    def __init__(self, tag_name_index, version):
+        self.tag_name_index = tag_name_index
+        self.version = version
+        self.type_codes = []
+        self.columns = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def add_element(self, codes, values):
+        columns = self.columns
+        type_codes = self.type_codes
+        for field, code in enumerate(codes):
+            if field == len(columns):
+                if self.length:
+                    # earlier elements lack the field, so the column holds None
+                    type_codes.append(None)
+                    columns.append([None] * self.length)
+                else:
+                    type_codes.append(code)
+                    columns.append(new_column(code))
+            elif type_codes[field] != code:
+                if type_codes[field] is not None:
+                    type_codes[field] = None
+                    columns[field] = list(columns[field])
+            columns[field].append(values[field])
+        self.length += 1
+        for field in range(len(codes), len(columns)):
+            if type(columns[field]) is not list:
+                type_codes[field] = None
+                columns[field] = list(columns[field])
+            columns[field].append(None)
+
+    def to_numpy(self):
+        """
+        Replace typed columns with NumPy arrays; list columns are left as they are.
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for NumPy columns')
+        for field, code in enumerate(self.type_codes):
+            if code in FIELD_TYPES:
+                self.columns[field] = numpy.array(self.columns[field], dtype=FIELD_TYPES[code][1])
+
+
+def read_columns(parser, start, use_numpy=False, type_code=TypeCodes.RECODE_ARRAY):
+    """
+    Decode the record array whose header starts at start (after its type code) into RecordColumns.
+    type_code is the array's type code byte, which ABCA replays need to read the header.
+    """
+    reader = parser.reader
+    codec = parser.codec
+    decoders = codec.decoders
+    record_kinds = codec.RECORD_KINDS
+    read_uint8 = reader.read_uint8_value
+    reader.index = start
+    tag_name_index, version, end = parser.read_record_header(reader, codec, type_code)
+    result = RecordColumns(tag_name_index, version)
+    while reader.index < end:
+        element_end = codec.read_offset(reader)
+        codes = []
+        values = []
+        while reader.index < element_end:
+            code = read_uint8()
+            codes.append(record_kinds[code] or PACKED_TYPES.get(code, code))
+            values.append(decoders[code](reader))
+        result.add_element(codes, values)
+    if use_numpy:
+        result.to_numpy()
+    return result
+
+
+def select_columns(parser, path, use_numpy=False):
+    """
+    RecordColumns of every record array matching path (see Parser.select).
+    Matches that are not record arrays are ignored.
+    """
+    results = []
+    record_kinds = parser.codec.RECORD_KINDS
+    for code, start, end in parser.select_offsets(path):
+        if code is not None and record_kinds[code] == TypeCodes.RECODE_ARRAY:
+            results.append(read_columns(parser, start, use_numpy, code))
+    parser.reader.index = 0
+    return results
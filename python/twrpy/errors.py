@@ -17,4 +17,4 @@ class InvalidDataStructureError(Exception):
         super(InvalidDataStructureError,self).__init__(type_code, reason)
 
     def __str__(self):
-        return self.type_code, self.reason
\ No newline at end of file
+        return 'TypeCode: %s\t%s' % (hex(self.type_code), self.reason)
\ No newline at end of file
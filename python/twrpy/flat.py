@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import re
+import struct
+
+from twrpy.nodes import BaseNode, RecordNode, RecordArrayNode, ChildNode, get_state
+from twrpy.parser import Parser
+from twrpy.types import TypeCodes
+
+try:
+    unichr
+except NameError:
+    unichr = chr # Python 3
+
+text_type = type(u'')
+integer_types = (int, type(2 ** 64))
+# ca_unicode strings are UTF-16 code units and may hold surrogates, which UTF-8 cannot carry
+SURROGATES = re.compile(u'[\ud800-\udfff]')
+
+# value kinds
+V_NONE = 0x00 # BaseNode, decoded from an INVALID type code
+V_BOOL = 0x01
+V_INT = 0x02
+V_UINT = 0x03 # integers above the int64 range
+V_FLOAT = 0x04
+V_COORDINATES2D = 0x05
+V_COORDINATES3D = 0x06
+V_UNICODE = 0x07
+V_ASCII = 0x08
+V_RECORD = 0x09 # record nested in a ChildNode's values
+V_ARRAY = 0x40 # flag, combined with the element kind
+
+# kind of record table rows besides TypeCodes.RECODE and TypeCodes.RECODE_ARRAY
+R_CHILD = 0x00 # ChildNode, and the root row holding the top-level nodes
+
+COLUMNS = (
+    # name, typecode, index of the row count (records, values, ints, uints, floats,
+    # strings, string bytes, tags, ex_values)
+    ('record_kinds', 'B', 0),
+    ('record_tags', 'H', 0),
+    ('record_versions', 'B', 0),
+    ('record_parents', 'i', 0),
+    ('record_first_children', 'I', 0),
+    ('record_child_counts', 'I', 0),
+    ('record_value_starts', 'I', 0),
+    ('record_value_counts', 'I', 0),
+    ('record_offsets', 'I', 0),
+    ('record_elements', 'I', 0),
+    ('value_kinds', 'B', 1),
+    ('value_refs', 'I', 1),
+    ('value_counts', 'I', 1),
+    ('ints', 'q', 2),
+    ('uints', 'Q', 3),
+    ('floats', 'd', 4),
+    ('string_offsets', 'I', 5),
+    ('string_data', 'B', 6),
+    ('tags', 'I', 7),
+    ('ex_keys', 'I', 8),
+    ('ex_strings', 'I', 8),
+)
+
+# type code -> value kind; UINT64 is left to get_kind since most values fit the int64 pool
+CODE_KINDS = {
+    TypeCodes.INVALID: V_NONE,
+    TypeCodes.BOOL: V_BOOL,
+    TypeCodes.INT8: V_INT,
+    TypeCodes.INT16: V_INT,
+    TypeCodes.INT32: V_INT,
+    TypeCodes.INT64: V_INT,
+    TypeCodes.UINT8: V_INT,
+    TypeCodes.UINT16: V_INT,
+    TypeCodes.UINT32: V_INT,
+    TypeCodes.FLOAT32: V_FLOAT,
+    TypeCodes.FLOAT64: V_FLOAT,
+    TypeCodes.COORDINATES2D: V_COORDINATES2D,
+    TypeCodes.COORDINATES3D: V_COORDINATES3D,
+    TypeCodes.UTF16: V_UNICODE,
+    TypeCodes.ASCII: V_ASCII,
+    TypeCodes.ANGLE: V_INT,
+    TypeCodes.BOOL_TRUE: V_BOOL,
+    TypeCodes.BOOL_FALSE: V_BOOL,
+    TypeCodes.UINT32_ZERO: V_INT,
+    TypeCodes.UINT32_ONE: V_INT,
+    TypeCodes.UINT32_BYTE: V_INT,
+    TypeCodes.UINT32_SHORT: V_INT,
+    TypeCodes.UINT32_24BIT: V_INT,
+    TypeCodes.INT32_ZERO: V_INT,
+    TypeCodes.INT32_BYTE: V_INT,
+    TypeCodes.INT32_SHORT: V_INT,
+    TypeCodes.INT32_24BIT: V_INT,
+    TypeCodes.FLOAT32_ZERO: V_FLOAT,
+}
+for code, kind in list(CODE_KINDS.items()):
+    if code != TypeCodes.INVALID:
+        CODE_KINDS[code + 0x40] = kind | V_ARRAY
+
+
+def new_array(typecode):
+    """
+    Empty column. Python 2 has no 64 bit array typecodes; 'l'/'L' are used where
+    they are 8 bytes wide, a list otherwise.
+    """
+    try:
+        return array.array(typecode)
+    except ValueError:
+        if typecode == 'q':
+            fallback = 'l'
+        else:
+            fallback = 'L'
+        if struct.calcsize(fallback) == 8:
+            return array.array(fallback)
+        return []
+
+
+class FlatTree(object):
+    """
+    Decoded replay tree held in parallel columns instead of node objects.
+
+    Record rows (record_*) are in breadth-first order so that the records below a
+    record are contiguous (first_child, child_count). Row 0 is the root whose
+    values are the top-level nodes; record array elements are R_CHILD rows below
+    their array. Values live in the value table as (kind, ref, count) where ref
+    points into a typed pool (ints, uints, floats) or the interned string table
+    (string_offsets, string_data): a flag byte, 0 for bytes, 1 for UTF-8 text or 2 for
+    text with surrogates as uint16 code units, then the data. Nodes are built on access as FlatRecordNode,
+    FlatRecordArrayNode and FlatChildNode views.
+    """
+
+    def __init__(self, raw_header, header, footer, columns):
+        self.raw_header = raw_header
+        self.header = header
+        self.footer = footer
+        self.columns = columns
+        self.nodes = self.get_values(0)
+
+    def __len__(self):
+        return len(self.columns['record_kinds'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['nodes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nodes = self.get_values(0)
+
+    def read(self, name, index):
+        return self.columns[name][index]
+
+    def read_column(self, name, start, count):
+        return self.columns[name][start:start + count]
+
+    def get_string(self, string_id):
+        start, end = self.read_column('string_offsets', string_id, 2)
+        return decode_string(bytes(self.columns['string_data'][start:end]))
+
+    def get_record(self, record_id):
+        kind = self.read('record_kinds', record_id)
+        if kind == TypeCodes.RECODE:
+            return FlatRecordNode(self, record_id)
+        elif kind == TypeCodes.RECODE_ARRAY:
+            return FlatRecordArrayNode(self, record_id)
+        return FlatChildNode(self, record_id)
+
+    def get_children(self, record_id):
+        first = self.read('record_first_children', record_id)
+        return [self.get_record(i) for i in range(first, first + self.read('record_child_counts', record_id))]
+
+    def get_values(self, record_id):
+        start = self.read('record_value_starts', record_id)
+        count = self.read('record_value_counts', record_id)
+        if not count:
+            return []
+        kinds = self.read_column('value_kinds', start, count)
+        refs = self.read_column('value_refs', start, count)
+        counts = self.read_column('value_counts', start, count)
+        return [self.get_value(*value) for value in zip(kinds, refs, counts)]
+
+    def get_value(self, kind, ref, count):
+        if kind & V_ARRAY:
+            kind = kind & ~V_ARRAY
+            if kind == V_BOOL:
+                return [value != 0 for value in self.read_column('ints', ref, count)]
+            elif kind == V_INT:
+                return list(self.read_column('ints', ref, count))
+            elif kind == V_UINT:
+                return list(self.read_column('uints', ref, count))
+            elif kind == V_FLOAT:
+                return list(self.read_column('floats', ref, count))
+            elif kind == V_COORDINATES2D:
+                values = self.read_column('floats', ref, count * 2)
+                return list(zip(values[0::2], values[1::2]))
+            elif kind == V_COORDINATES3D:
+                values = self.read_column('floats', ref, count * 3)
+                return list(zip(values[0::3], values[1::3], values[2::3]))
+            return [self.get_string(i) for i in self.read_column('ints', ref, count)]
+        elif kind == V_BOOL:
+            return self.read('ints', ref) != 0
+        elif kind == V_INT:
+            return self.read('ints', ref)
+        elif kind == V_UINT:
+            return self.read('uints', ref)
+        elif kind == V_FLOAT:
+            return self.read('floats', ref)
+        elif kind == V_COORDINATES2D:
+            return tuple(self.read_column('floats', ref, 2))
+        elif kind == V_COORDINATES3D:
+            return tuple(self.read_column('floats', ref, 3))
+        elif kind == V_UNICODE or kind == V_ASCII:
+            return self.get_string(ref)
+        elif kind == V_RECORD:
+            return self.get_record(ref)
+        return BaseNode
+
+
+class FlatRecordNode(RecordNode):
+    """
+    RecordNode view of a FlatTree row; children and values are built on first access.
+    """
+
+    def __init__(self, tree, record_id):
+        self.tree = tree
+        self.record_id = record_id
+        self.reader = None
+        self.codec = None
+        self.parser = None
+        self.tag_name_index = tree.read('record_tags', record_id)
+        self.version = tree.read('record_versions', record_id)
+        self.offset = tree.read('record_offsets', record_id)
+
+    def __getattr__(self, name):
+        if name == 'children':
+            self.children = self.tree.get_children(self.record_id)
+            return self.children
+        elif name == 'values':
+            self.values = self.tree.get_values(self.record_id)
+            return self.values
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        self.children
+        self.values
+        state = RecordNode.__getstate__(self)
+        state['tree'] = None
+        return state
+
+
+class FlatRecordArrayNode(RecordArrayNode):
+    """
+    RecordArrayNode view of a FlatTree row; values (its elements) are built on first access.
+    """
+
+    def __init__(self, tree, record_id):
+        self.tree = tree
+        self.record_id = record_id
+        self.reader = None
+        self.codec = None
+        self.parser = None
+        self.tag_name_index = tree.read('record_tags', record_id)
+        self.version = tree.read('record_versions', record_id)
+        self.offset = tree.read('record_offsets', record_id)
+        self.elements_length = tree.read('record_elements', record_id)
+
+    def __getattr__(self, name):
+        if name == 'values':
+            self.values = self.tree.get_children(self.record_id)
+            return self.values
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        self.values
+        state = RecordArrayNode.__getstate__(self)
+        state['tree'] = None
+        return state
+
+
+class FlatChildNode(ChildNode):
+    """
+    ChildNode view of a FlatTree row; values are built on first access.
+    """
+
+    def __init__(self, tree, record_id):
+        self.tree = tree
+        self.record_id = record_id
+        self.children = []
+
+    def __getattr__(self, name):
+        if name == 'values':
+            self.values = self.tree.get_values(self.record_id)
+            return self.values
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        self.values
+        state = get_state(self)
+        state['tree'] = None
+        return state
+
+
+def decode_string(data):
+    """
+    String of the string table entry data (flag byte included).
+    """
+    if data[:1] == b'\x01':
+        return data[1:].decode('utf-8')
+    elif data[:1] == b'\x02':
+        return u''.join([unichr(c) for c in struct.unpack('<%dH' % ((len(data) - 1) // 2), data[1:])])
+    return data[1:]
+
+
+def is_record(value):
+    return isinstance(value, (RecordNode, RecordArrayNode, ChildNode))
+
+
+def record_children(node):
+    if isinstance(node, RecordNode):
+        return list(node.children) + [value for value in node.values if is_record(value)]
+    return [value for value in node.values if is_record(value)]
+
+
+def get_kind(value):
+    if isinstance(value, bool):
+        return V_BOOL
+    elif isinstance(value, integer_types):
+        if -0x8000000000000000 <= value < 0x8000000000000000:
+            return V_INT
+        return V_UINT
+    elif isinstance(value, float):
+        return V_FLOAT
+    elif isinstance(value, tuple):
+        return V_COORDINATES2D if len(value) == 2 else V_COORDINATES3D
+    elif isinstance(value, text_type):
+        return V_UNICODE
+    elif isinstance(value, bytes):
+        return V_ASCII
+    return V_NONE
+
+
+class FlatBuilder(object):
+    """
+    Fills the columns of a FlatTree, from a node tree (add_tree) or straight from a reader (parse_flat).
+    """
+
+    def __init__(self, footer):
+        self.footer = footer
+        self.columns = {}
+        for name, typecode, count_index in COLUMNS:
+            self.columns[name] = new_array(typecode)
+        self.columns['string_data'] = bytearray()
+        self.strings = {}
+        self.columns['string_offsets'].append(0)
+        for tag in footer['tags']:
+            self.columns['tags'].append(self.add_string(tag))
+        for key, value in sorted(footer.get('ex_values', {}).items()):
+            self.columns['ex_keys'].append(key)
+            self.columns['ex_strings'].append(self.add_string(value))
+
+    def add_string(self, value):
+        key = (type(value), value)
+        string_id = self.strings.get(key)
+        if string_id is None:
+            data = self.columns['string_data']
+            if isinstance(value, text_type) and SURROGATES.search(value) is None:
+                data += b'\x01' + value.encode('utf-8')
+            elif isinstance(value, text_type):
+                data += b'\x02' + struct.pack('<%dH' % len(value), *[ord(c) for c in value])
+            else:
+                data += b'\x00' + value
+            string_id = self.strings[key] = len(self.strings)
+            self.columns['string_offsets'].append(len(data))
+        return string_id
+
+    def add_scalar(self, kind, value):
+        """
+        Append value to its pool and return its position.
+        """
+        if kind == V_BOOL or kind == V_INT:
+            pool = self.columns['ints']
+            pool.append(int(value))
+        elif kind == V_UINT:
+            pool = self.columns['uints']
+            pool.append(value)
+        elif kind == V_FLOAT:
+            pool = self.columns['floats']
+            pool.append(value)
+        elif kind == V_COORDINATES2D or kind == V_COORDINATES3D:
+            pool = self.columns['floats']
+            pool.extend(value)
+            return len(pool) - len(value)
+        elif kind == V_UNICODE or kind == V_ASCII:
+            pool = self.columns['ints']
+            pool.append(self.add_string(value))
+        else:
+            return 0
+        return len(pool) - 1
+
+    def get_value_row(self, value, kind=None):
+        """
+        (kind, ref, count) of value, with its contents added to the pools.
+        """
+        if isinstance(value, list):
+            if kind is None:
+                kind = get_kind(value[0]) if value else V_INT
+                if kind == V_INT and any(get_kind(element) == V_UINT for element in value):
+                    kind = V_UINT
+                kind |= V_ARRAY
+            element_kind = kind & ~V_ARRAY
+            if element_kind == V_INT or element_kind == V_BOOL:
+                pool = self.columns['ints']
+                ref = len(pool)
+                pool.extend(value)
+            elif element_kind == V_FLOAT:
+                pool = self.columns['floats']
+                ref = len(pool)
+                pool.extend(value)
+            else:
+                ref = None
+                for element in value:
+                    position = self.add_scalar(element_kind, element)
+                    if ref is None:
+                        ref = position
+            return kind, ref or 0, len(value)
+        if kind is None:
+            kind = get_kind(value)
+        if kind == V_UNICODE or kind == V_ASCII:
+            return kind, self.add_string(value), 0
+        return kind, self.add_scalar(kind, value), 0
+
+    def add_record_row(self, kind, tag, version, offset, elements, parent):
+        columns = self.columns
+        columns['record_kinds'].append(kind)
+        columns['record_tags'].append(tag)
+        columns['record_versions'].append(version)
+        columns['record_offsets'].append(offset)
+        columns['record_elements'].append(elements)
+        columns['record_parents'].append(parent)
+
+    def add_value_rows(self, rows):
+        columns = self.columns
+        columns['record_value_starts'].append(len(columns['value_kinds']))
+        columns['record_value_counts'].append(len(rows))
+        for kind, ref, count in rows:
+            columns['value_kinds'].append(kind)
+            columns['value_refs'].append(ref)
+            columns['value_counts'].append(count)
+
+    def add_tree(self, nodes):
+        """
+        Add the rows of a decoded node tree, breadth first.
+        """
+        columns = self.columns
+        root = ChildNode()
+        root.values = nodes
+        order = [root]
+        ids = {}
+        parents = [-1]
+        i = 0
+        while i < len(order):
+            children = record_children(order[i])
+            columns['record_first_children'].append(len(order))
+            columns['record_child_counts'].append(len(children))
+            for child in children:
+                ids[id(child)] = len(order)
+                parents.append(i)
+                order.append(child)
+            i += 1
+
+        for record_id, node in enumerate(order):
+            if isinstance(node, RecordNode):
+                self.add_record_row(TypeCodes.RECODE, node.tag_name_index, node.version, node.offset, 0,
+                                    parents[record_id])
+                values = [value for value in node.values if not is_record(value)]
+            elif isinstance(node, RecordArrayNode):
+                self.add_record_row(TypeCodes.RECODE_ARRAY, node.tag_name_index, node.version,
+                                    node.offset, node.elements_length, parents[record_id])
+                values = []
+            else:
+                self.add_record_row(R_CHILD, 0, 0, 0, 0, parents[record_id])
+                values = node.values
+            self.add_value_rows([(V_RECORD, ids[id(value)], 0) if is_record(value) else self.get_value_row(value)
+                                 for value in values])
+
+    def build(self, raw_header, header):
+        return FlatTree(raw_header, header, self.footer, self.columns)
+
+
+def from_parser(parser):
+    """
+    FlatTree of the nodes a parser has decoded.
+    """
+    index = parser.reader.index
+    parser.reader.index = 0
+    raw_header = bytes(parser.reader.next(16))
+    parser.reader.index = index
+    builder = FlatBuilder(parser.footer)
+    builder.add_tree(parser.nodes)
+    return builder.build(raw_header, parser.header)
+
+
+def parse_flat(reader, codec, parser_class=Parser):
+    """
+    Decode a replay straight into a FlatTree without building node objects.
+    """
+    reader.index = 0
+    raw_header = bytes(reader.next(16))
+    header = parser_class.get_header(reader)
+    footer = parser_class.get_footer(reader, header)
+    codec = codec.bind(header, footer)
+    codec.decoders = parser_class.get_decoders(codec)
+    nodes_index = header['nodes_index']
+    reader.index = nodes_index[0]
+    builder = FlatBuilder(footer)
+    fill_flat(builder, reader, codec, nodes_index[1])
+    reader.index = 0
+    return builder.build(raw_header, header)
+
+
+def fill_flat(builder, reader, codec, end, elements=False):
+    """
+    Decode the nodes from reader.index to end into the rows of builder, as the values of
+    its root row; with elements, record array elements instead, as the root's children.
+
+    Records are numbered depth first while decoding. A record's value rows are kept
+    until the record ends so that they are contiguous, then the rows are renumbered
+    breadth first.
+    """
+    decoders = codec.decoders
+    record_kinds = codec.RECORD_KINDS
+    read_offset = codec.read_offset
+    read_uint8 = reader.read_uint8_value
+
+    get_value_row = builder.get_value_row
+    kinds = []
+    tags = []
+    versions = []
+    offsets = []
+    element_counts = []
+    parents = []
+    # value rows in depth first order: (start, count) per record
+    value_slices = []
+    value_rows = []
+
+    def open_record(kind, tag, version, offset, element_count, parent):
+        kinds.append(kind)
+        tags.append(tag)
+        versions.append(version)
+        offsets.append(offset)
+        element_counts.append(element_count)
+        parents.append(parent)
+        value_slices.append(None)
+        return len(kinds) - 1
+
+    # (record id, kind, end offset, value rows); the root row reads elements like a record array
+    root_kind = TypeCodes.RECODE_ARRAY if elements else R_CHILD
+    stack = [(open_record(R_CHILD, 0, 0, 0, 0, -1), root_kind, end, [])]
+    while stack:
+        record_id, kind, end, rows = stack[-1]
+        if reader.index >= end:
+            stack.pop()
+            value_slices[record_id] = (len(value_rows), len(rows))
+            value_rows.extend(rows)
+            continue
+        if kind == TypeCodes.RECODE_ARRAY:
+            element_end = read_offset(reader)
+            stack.append((open_record(R_CHILD, 0, 0, 0, 0, record_id), R_CHILD, element_end, []))
+            continue
+        code = read_uint8()
+        record_kind = record_kinds[code]
+        if record_kind is not None:
+            tag, version = codec.read_record_tag(reader, code)
+            if record_kind == TypeCodes.RECODE_ARRAY:
+                record_end, element_count = codec.read_array_header(reader)
+            else:
+                record_end = read_offset(reader)
+                element_count = 0
+            child_id = open_record(record_kind, tag, version, record_end, element_count, record_id)
+            if kind == R_CHILD:
+                rows.append((V_RECORD, child_id, 0))
+            stack.append((child_id, record_kind, record_end, []))
+        else:
+            rows.append(get_value_row(decoders[code](reader), CODE_KINDS.get(code)))
+
+    # breadth first order
+    children = [[] for i in range(len(kinds))]
+    for record_id in range(1, len(kinds)):
+        children[parents[record_id]].append(record_id)
+    order = [0]
+    for record_id in order:
+        order.extend(children[record_id])
+    new_ids = [0] * len(order)
+    for position, record_id in enumerate(order):
+        new_ids[record_id] = position
+
+    columns = builder.columns
+    for record_id in order:
+        record_children = children[record_id]
+        parent = parents[record_id]
+        builder.add_record_row(kinds[record_id], tags[record_id], versions[record_id], offsets[record_id],
+                               element_counts[record_id], new_ids[parent] if parent >= 0 else -1)
+        columns['record_first_children'].append(new_ids[record_children[0]] if record_children else 0)
+        columns['record_child_counts'].append(len(record_children))
+        start, count = value_slices[record_id]
+        builder.add_value_rows([(V_RECORD, new_ids[row[1]], 0) if row[0] == V_RECORD else row
+                                for row in value_rows[start:start + count]])
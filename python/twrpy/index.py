@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import os
+import struct
+import sys
+
+from twrpy.codecs import get_codec
+from twrpy.parser import Parser
+from twrpy.reader import MappedBinaryReader
+from twrpy.types import TypeCodes
+from twrpy.util import array_from_bytes, array_to_bytes, atomic_write
+
+
+class RecordIndex:
+    """
+    Table of every record in a replay, one row per RecordNode, RecordArrayNode and record array element.
+    Elements are stored as RECODE rows carrying the tag and version of their array.
+    find and decode read single records through the table, see select_indexed.
+
+    Sidecar file:
+        char[4] magic 'TWRI'
+        uint16 format version
+        uint32 number of records
+        char[16] header of the indexed replay
+        uint64 size of the indexed replay
+        float64 modification time of the indexed replay
+        uint8[n] type codes
+        uint16[n] tag name indexes
+        uint8[n] versions
+        uint32[n] offsets of the type code (or element size) byte
+        uint32[n] offsets of the first body byte
+        uint32[n] offsets of first byte after end of record
+        int32[n] parent record ids, -1 at top level
+        uint16[n] depths
+    """
+
+    MAGIC = b'TWRI'
+    VERSION = 2
+    SIDECAR_SUFFIX = '.idx'
+    _HEADER = struct.Struct('<4sHI16sQd')
+    _COLUMNS = (
+        ('type_codes', 'B'),
+        ('tags', 'H'),
+        ('versions', 'B'),
+        ('starts', 'I'),
+        ('bodies', 'I'),
+        ('ends', 'I'),
+        ('parents', 'i'),
+        ('depths', 'H'),
+    )
+
+    def __init__(self, replay_header=b'', replay_size=0, replay_mtime=0.0):
+        self.replay_header = replay_header
+        # identify the replay the sidecar was built from, see get_index
+        self.replay_size = replay_size
+        self.replay_mtime = replay_mtime
+        for name, typecode in self._COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, type_code, tag, version, start, body, end, parent, depth):
+        self.type_codes.append(type_code)
+        self.tags.append(tag)
+        self.versions.append(version)
+        self.starts.append(start)
+        self.bodies.append(body)
+        self.ends.append(end)
+        self.parents.append(parent)
+        self.depths.append(depth)
+        return len(self.starts) - 1
+
+    def get_record(self, record_id):
+        """
+        (type code, tag index, version, start, body, end, parent id, depth)
+        """
+        return tuple(getattr(self, name)[record_id] for name, typecode in self._COLUMNS)
+
+    def get_children(self, record_id):
+        return [i for i, parent in enumerate(self.parents) if parent == record_id]
+
+    def is_element(self, record_id):
+        parent = self.parents[record_id]
+        return parent >= 0 and self.type_codes[parent] == TypeCodes.RECODE_ARRAY
+
+    def find(self, path, tags):
+        """
+        Ids of the records matching a tag path, as Parser.select matches it: segments are
+        tag names or '*', elements of a record array are matched by position.
+        tags is the tag table of the footer. Only the table is read.
+        """
+        if not isinstance(path, bytes):
+            path = path.encode('ascii')
+        segments = path.strip(b'/').split(b'/')
+        last = len(segments) - 1
+        tag_ids = []
+        for segment in segments:
+            if segment == b'*':
+                tag_ids.append(None)
+            else:
+                tag_ids.append(set(i for i, tag in enumerate(tags) if tag == segment))
+        # records whose path matches the segments down to their depth
+        matched = set()
+        # record array id -> position of its next element
+        positions = {}
+        results = []
+        for record_id in range(len(self)):
+            depth = self.depths[record_id]
+            parent = self.parents[record_id]
+            if depth > last or (parent >= 0 and parent not in matched):
+                continue
+            if self.is_element(record_id):
+                position = positions.get(parent, 0)
+                positions[parent] = position + 1
+                segment = segments[depth]
+                match = segment == b'*' or segment == str(position).encode('ascii')
+            else:
+                match = tag_ids[depth] is None or self.tags[record_id] in tag_ids[depth]
+            if not match:
+                continue
+            if depth == last:
+                results.append(record_id)
+            else:
+                matched.add(record_id)
+        return results
+
+    def decode(self, reader, codec, record_id, parser_class=Parser):
+        """
+        Decode one record, or a ChildNode for an element row, reading only its bytes.
+        codec must be bound and hold its decoder table (Parser.bind_codec).
+        """
+        if self.is_element(record_id):
+            reader.index = self.bodies[record_id]
+            node = parser_class.read_element(reader, codec, self.ends[record_id])
+        else:
+            # record tags are read with the type code byte before the reader's index
+            reader.index = self.starts[record_id]
+            node = parser_class.decode(reader, codec, reader.read_uint8_value())
+        reader.index = 0
+        return node
+
+    @classmethod
+    def build(cls, reader, codec, header):
+        """
+        One pass over the node region. Value and array nodes are stepped over, never decoded.
+        """
+        reader.index = 0
+        index = cls(bytes(reader.next(16)))
+        codec = codec.bind(header, None)
+        skippers = Parser.get_skippers(codec)
+        record_kinds = codec.RECORD_KINDS
+        read_offset = codec.read_offset
+        read_uint8 = reader.read_uint8_value
+
+        reader.index = header['nodes_index'][0]
+        # (end offset, record id, (tag, version) of the record array whose elements are being read)
+        stack = [(header['nodes_index'][1], -1, None)]
+        while stack:
+            end, parent, array_info = stack[-1]
+            if reader.index >= end:
+                stack.pop()
+                continue
+            start = reader.index
+            depth = len(stack) - 1
+            if array_info is not None:
+                element_end = read_offset(reader)
+                record_id = index.add(TypeCodes.RECODE, array_info[0], array_info[1],
+                                      start, reader.index, element_end, parent, depth)
+                stack.append((element_end, record_id, None))
+                continue
+
+            code = read_uint8()
+            kind = record_kinds[code]
+            if kind is not None:
+                tag, version = codec.read_record_tag(reader, code)
+                if kind == TypeCodes.RECODE_ARRAY:
+                    record_end = codec.read_array_header(reader)[0]
+                    array_info = (tag, version)
+                else:
+                    record_end = read_offset(reader)
+                record_id = index.add(kind, tag, version, start, reader.index, record_end, parent, depth)
+                stack.append((record_end, record_id, array_info))
+            else:
+                skippers[code](reader)
+        reader.index = 0
+        return index
+
+    @classmethod
+    def sidecar_path(cls, path):
+        return path + cls.SIDECAR_SUFFIX
+
+    def save(self, path):
+        """
+        Write the sidecar to path through atomic_write, so that readers never see a partly written sidecar.
+        """
+        def write(fp):
+            fp.write(self._HEADER.pack(self.MAGIC, self.VERSION, len(self), self.replay_header,
+                                       self.replay_size, self.replay_mtime))
+            for name, typecode in self._COLUMNS:
+                column = getattr(self, name)
+                if sys.byteorder == 'big':
+                    column = array.array(typecode, column)
+                    column.byteswap()
+                fp.write(array_to_bytes(column))
+        atomic_write(path, write)
+
+    @classmethod
+    def load(cls, path):
+        fp = open(path, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        magic, version, count, replay_header, replay_size, replay_mtime = cls._HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('Not a record index sidecar(%s).' % path)
+        index = cls(replay_header, replay_size, replay_mtime)
+        columns = [getattr(index, name) for name, typecode in cls._COLUMNS]
+        # a truncated column may still be a whole number of items long
+        if len(data) != cls._HEADER.size + sum(column.itemsize for column in columns) * count:
+            raise ValueError('Record index sidecar of the wrong size(%s).' % path)
+        position = cls._HEADER.size
+        for column in columns:
+            size = column.itemsize * count
+            array_from_bytes(column, data[position:position+size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            position += size
+        return index
+
+
+def get_index(path, save=True):
+    """
+    Load the sidecar index of a replay, building (and saving) it if missing or stale.
+    A sidecar is used only if the replay's header, size and modification time are the ones
+    it was built from. If it cannot be written the built index is returned all the same.
+    """
+    sidecar = RecordIndex.sidecar_path(path)
+    fp = open(path, 'rb')
+    reader = MappedBinaryReader(fp)
+    try:
+        stat = os.fstat(fp.fileno())
+        replay_header = bytes(reader.next(16))
+        if os.path.exists(sidecar):
+            try:
+                index = RecordIndex.load(sidecar)
+            except (ValueError, struct.error):
+                index = None
+            if index is not None and (index.replay_header, index.replay_size, index.replay_mtime) == \
+                    (replay_header, stat.st_size, stat.st_mtime):
+                return index
+        codec = get_codec(reader)
+        index = RecordIndex.build(reader, codec, Parser.get_header(reader))
+        index.replay_size = stat.st_size
+        index.replay_mtime = stat.st_mtime
+    finally:
+        reader.close()
+        fp.close()
+    if save:
+        try:
+            index.save(sidecar)
+        except (IOError, OSError):
+            # the replay's directory is not writable; the index is only kept in memory
+            pass
+    return index
+
+
+def select_indexed(path, tag_path, save=True):
+    """
+    Parser.select without decoding the replay: the records matching tag_path are found in
+    the sidecar index (see get_index) and only their bytes are decoded.
+    """
+    index = get_index(path, save)
+    fp = open(path, 'rb')
+    reader = MappedBinaryReader(fp)
+    try:
+        codec = get_codec(reader)
+        header = Parser.get_header(reader)
+        footer = Parser.get_footer(reader, header)
+        codec = codec.bind(header, footer)
+        codec.decoders = Parser.get_decoders(codec)
+        return [index.decode(reader, codec, record_id) for record_id in index.find(tag_path, footer['tags'])]
+    finally:
+        reader.close()
+        fp.close()
@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from twrpy.errors import InvalidDataStructureError
 from twrpy.types import TypeCodes
 
 ##################################################################
 
 class BaseNode:
     type_code = None
+    value_type = None # BinaryReader type of a fixed-width value, None if variable-width
+    value_width = 1
     def __init__(self, reader, codec):
         self.reader = reader
         self.codec = codec
@@ -18,6 +21,14 @@ class BaseNode:
 
 class BoolNode(BaseNode):
     type_code = TypeCodes.BOOL
+    value_type = 'uint8'
+    BOOLS = {
+        TypeCodes.BOOL_TRUE: True,
+        TypeCodes.BOOL_FALSE: False,
+        0x00: False,
+        0x01: True,
+    }
+
     def get_value(self):
         value = self.reader.read_uint8_value()
         if value == TypeCodes.BOOL_TRUE:
@@ -29,71 +40,83 @@ class BoolNode(BaseNode):
         elif value == 0x01:
             return True
         else:
-            raise
+            raise InvalidDataStructureError(self.type_code, 'invalid bool value')
 
 
 class Int8Node(BaseNode):
     type_code = TypeCodes.INT8
+    value_type = 'int8'
     def get_value(self):
         return self.reader.read_int8_value()
 
 
 class UInt8Node(BaseNode):
     type_code = TypeCodes.UINT8
+    value_type = 'uint8'
     def get_value(self):
         return self.reader.read_uint8_value()
 
 
 class Int16Node(BaseNode):
     type_code = TypeCodes.INT16
+    value_type = 'int16'
     def get_value(self):
         return self.reader.read_int16_value()
 
 
 class UInt16Node(BaseNode):
     type_code = TypeCodes.UINT16
+    value_type = 'uint16'
     def get_value(self):
         return self.reader.read_uint16_value()
 
 
 class Int32Node(BaseNode):
     type_code = TypeCodes.INT32
+    value_type = 'int32'
     def get_value(self):
         return self.reader.read_int32_value()
 
 
 class UInt32Node(BaseNode):
     type_code = TypeCodes.UINT32
+    value_type = 'uint32'
     def get_value(self):
         return self.reader.read_uint32_value()
 
 
 class Int64Node(BaseNode):
     type_code = TypeCodes.INT64
+    value_type = 'int64'
     def get_value(self):
         return self.reader.read_int64_value()
 
 
 class UInt64Node(BaseNode):
     type_code = TypeCodes.UINT64
+    value_type = 'uint64'
     def get_value(self):
         return self.reader.read_uint64_value()
 
 
 class Float32Node(BaseNode):
     type_code = TypeCodes.FLOAT32
+    value_type = 'float32'
     def get_value(self):
         return self.reader.read_float32_value()
 
 
 class Float64Node(BaseNode):
     type_code = TypeCodes.FLOAT64
+    value_type = 'float64'
     def get_value(self):
-        return self.reader.read_fleat64_value()
+        return self.reader.read_float64_value()
 
 
 class Coordinates2DNode(BaseNode):
     type_code = TypeCodes.COORDINATES2D
+    value_type = 'float32'
+    value_width = 2
     def get_value(self):
         value_x = self.reader.read_float32_value()
         value_y = self.reader.read_float32_value()
@@ -102,6 +125,8 @@ class Coordinates2DNode(BaseNode):
 
 class Coordinates3DNode(BaseNode):
     type_code = TypeCodes.COORDINATES3D
+    value_type = 'float32'
+    value_width = 3
 
     def get_value(self):
         value_x = self.reader.read_float32_value()
@@ -132,10 +157,41 @@ class AsciiNode(BaseNode):
 
 class AngleNode(BaseNode):
     type_code = TypeCodes.ANGLE
+    value_type = 'uint16'
     def get_value(self):
         return self.reader.read_uint16_value()
 
 
+# Packed encodings: an int32/uint32 stored in fewer bytes, or a constant stored in the type code alone.
+
+class UInt32ByteNode(UInt8Node):
+    type_code = TypeCodes.UINT32_BYTE
+
+
+class UInt32ShortNode(UInt16Node):
+    type_code = TypeCodes.UINT32_SHORT
+
+
+class Int32ByteNode(Int8Node):
+    type_code = TypeCodes.INT32_BYTE
+
+
+class Int32ShortNode(Int16Node):
+    type_code = TypeCodes.INT32_SHORT
+
+
+class UInt24Node(BaseNode):
+    type_code = TypeCodes.UINT32_24BIT
+    def get_value(self):
+        return self.reader.read_uint24_value()
+
+
+class Int24Node(BaseNode):
+    type_code = TypeCodes.INT32_24BIT
+    def get_value(self):
+        return self.reader.read_int24_value()
+
+
 ##################################################################
 
 
@@ -165,12 +221,11 @@ class BaseArrayNode(BaseNode):
         return self.reader.read_uint8_value()
 
     def get_offset(self):
-        if self.codec.CODEC_NAME == 'ABCA':
-            pass
-        else:
-            return self.reader.read_uint32_value()
+        return self.codec.read_offset(self.reader)
 
     def get_values(self):
+        if self.value_type is not None:
+            return self.get_bulk_values()
         values = []
         while True:
             if self.reader.index >= self.offset:
@@ -180,12 +235,40 @@ class BaseArrayNode(BaseNode):
                 values.append(value)
         return values
 
+    def get_count(self, size):
+        """
+        Number of size-byte elements up to the end offset.
+        """
+        span = self.offset - self.reader.index
+        if span % size:
+            raise InvalidDataStructureError(self.type_code, 'array of %d bytes, not a multiple of %d. Index: %s' % (
+                span, size, hex(self.reader.index)))
+        return span // size
+
+    def get_bulk_values(self):
+        """
+        Fixed-width elements: the element count follows from the end offset,
+        so the whole span is decoded at once.
+        """
+        size = self.reader._TYPES[self.value_type].size * self.value_width
+        values = self.reader.read_values(self.value_type, self.get_count(size) * self.value_width)
+        return self.convert_values(values)
+
+    def convert_values(self, values):
+        return list(values)
+
 
 class BoolArrayNode(BoolNode, BaseArrayNode):
     type_code = TypeCodes.BOOL_ARRAY
     def __init__(self,reader,codec):
         BaseArrayNode.__init__(self,reader,codec)
 
+    def convert_values(self, values):
+        try:
+            return [self.BOOLS[value] for value in values]
+        except KeyError:
+            raise InvalidDataStructureError(self.type_code, 'invalid bool value')
+
 
 class Int8ArrayNode(Int8Node, BaseArrayNode):
     type_code = TypeCodes.INT8_ARRAY
@@ -252,12 +335,18 @@ class Coordinates2DArrayNode(Coordinates2DNode,BaseArrayNode):
     def __init__(self,reader,codec):
         BaseArrayNode.__init__(self,reader,codec)
 
+    def convert_values(self, values):
+        return list(zip(values[0::2],values[1::2]))
+
 
 class Coordinates3DArrayNode(Coordinates3DNode, BaseArrayNode):
     type_code = TypeCodes.COORDINATES3D_ARRAY
     def __init__(self,reader,codec):
         BaseArrayNode.__init__(self,reader,codec)
 
+    def convert_values(self, values):
+        return list(zip(values[0::3],values[1::3],values[2::3]))
+
 
 class Utf16ArrayNode(Utf16Node,BaseArrayNode):
     type_code = TypeCodes.UTF16_ARRAY
@@ -277,68 +366,168 @@ class AngleArrayNode(AngleNode,BaseArrayNode):
         BaseArrayNode.__init__(self,reader,codec)
 
 
+class UInt32ByteArrayNode(UInt32ByteNode,BaseArrayNode):
+    type_code = TypeCodes.UINT32_BYTE_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+
+class UInt32ShortArrayNode(UInt32ShortNode,BaseArrayNode):
+    type_code = TypeCodes.UINT32_SHORT_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+
+class Int32ByteArrayNode(Int32ByteNode,BaseArrayNode):
+    type_code = TypeCodes.INT32_BYTE_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+
+class Int32ShortArrayNode(Int32ShortNode,BaseArrayNode):
+    type_code = TypeCodes.INT32_SHORT_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+
+class UInt24ArrayNode(UInt24Node,BaseArrayNode):
+    type_code = TypeCodes.UINT32_24BIT_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+    def get_values(self):
+        return list(self.reader.read_uint24_values(self.get_count(3)))
+
+
+class Int24ArrayNode(Int24Node,BaseArrayNode):
+    type_code = TypeCodes.INT32_24BIT_ARRAY
+    def __init__(self,reader,codec):
+        BaseArrayNode.__init__(self,reader,codec)
+
+    def get_values(self):
+        return self.reader.read_int24_values(self.get_count(3))
+
+
+class BoolTrueArrayNode(BaseArrayNode):
+    """
+    One byte per element, each element is True whatever the byte.
+    """
+    type_code = TypeCodes.BOOL_TRUE_ARRAY
+    constant = True
+
+    def get_values(self):
+        count = self.offset - self.reader.index
+        self.reader.index = self.offset
+        return [self.constant] * count
+
+
+class BoolFalseArrayNode(BoolTrueArrayNode):
+    type_code = TypeCodes.BOOL_FALSE_ARRAY
+    constant = False
+
+
 ##################################################################
 
-class RecordNode:
+def get_state(node):
+    """
+    Slot attributes of a node, plus the __dict__ of subclasses that have one.
+    The reader and codec stay with the process that decoded the node.
+    """
+    state = dict(getattr(node, '__dict__', ()))
+    for cls in type(node).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name not in state and hasattr(node, name):
+                state[name] = getattr(node, name)
+    if 'reader' in state:
+        state['reader'] = None
+        state['codec'] = None
+    return state
+
+
+def set_state(node, state):
+    for name, value in state.items():
+        setattr(node, name, value)
+
+
+class RecordNode(object):
+    __slots__ = ('reader', 'codec', 'parser', 'tag_name_index', 'version', 'children', 'values', 'offset')
     type_code = TypeCodes.RECODE
+    # get_nodes fills children and values; kept for callers of the old attribute
+    nodes = None
 
-    def __init__(self, reader, codec, parser, is_parent=False):
+    def __init__(self, reader, codec, parser, is_parent=False, decode_body=True):
         """
         Record Node Structure:
             uint16 tag name - it's index to table of tags in the footer. index
             uint8 version - version number - starts with 0, updated every time object format changes
             uint32 offset of first byte after end of record
+        ABCA replays use the short header and uintvar size described in CaCodec.
+        With decode_body=False only the header is read and the caller fills children/values.
+        The reader, codec and parser are released once the node is read.
         """
         self.reader = reader
         self.codec = codec
         self.parser = parser
-        self.tag_name_index = self.get_tag_name_index()
-        self.version = self.get_version()
+        self.tag_name_index, self.version = self.get_tag()
         self.children = []
         self.values = []
         self.offset = self.get_offset()
-        self.nodes = self.get_nodes()
+        if decode_body:
+            self.get_nodes()
+        self.release()
 
+    def release(self):
+        """
+        Drop the decoding machinery; the attributes stay, set to None.
+        """
+        self.reader = None
+        self.codec = None
+        self.parser = None
+
+    def get_tag(self):
+        """
+        (tag name index, version); the type code must be the byte before the reader's index.
+        """
+        return self.codec.read_record_tag(self.reader)
+
+    # the header is read by get_tag; these return what it decoded
     def get_tag_name_index(self):
-        return self.reader.read_uint16_value()
+        return self.tag_name_index
 
     def get_version(self):
-        return self.reader.read_uint8_value()
+        return self.version
 
     def get_read_size(self):
-        cvalue = self.reader.read_uint8_value()
-        result = 0
-        while (cvalue & 0x80) != 0:
-            result = (result << 7) * (cvalue & 0x7f)
-            cvalue = self.reader.read_uint8_value()
-        return (result << 7) + (cvalue & 0x7f)
+        return self.reader.read_uintvar_value()
 
     def get_offset(self):
-        if self.codec.CODEC_NAME in ["ABCE","ABCF"]:
-            result = self.reader.read_uint32_value()
-        elif self.codec.CODEC_NAME == 'ABCA':
-            result = self.get_read_size() + self.reader.index
-        else:
-            raise
-        return result
+        return self.codec.read_offset(self.reader)
 
     def get_nodes(self):
+        record_kinds = self.codec.RECORD_KINDS
         while True:
             if self.reader.index >= self.offset:
                 break
             else:
                 cvalue = self.reader.read_uint8_value()
                 result = self.parser.decode(self.reader,self.codec,cvalue)
-                if cvalue in [TypeCodes.RECODE, TypeCodes.RECODE_ARRAY]:
+                if record_kinds[cvalue] is not None:
                     self.children.append(result)
                 else:
                     self.values.append(result)
 
+    def __getstate__(self):
+        return get_state(self)
+
+    def __setstate__(self, state):
+        set_state(self, state)
 
-class RecordArrayNode:
+
+class RecordArrayNode(object):
+    __slots__ = ('reader', 'codec', 'parser', 'tag_name_index', 'version', 'offset', 'elements_length', 'values')
     type_code = TypeCodes.RECODE_ARRAY
 
-    def __init__(self,reader,codec, parser):
+    def __init__(self,reader,codec, parser, decode_body=True):
         """
         uint16 tag name - it's index to table of tags in the footer
         uint8 version - version number
@@ -349,27 +538,42 @@ class RecordArrayNode:
         uint32 offset of first byte after end of record #1
         contents of record 1
         ...
+        ABCA replays use the short header and uintvar sizes and count described in CaCodec.
+        values holds one ChildNode per element; records nested in an element end up in its values too.
+        With decode_body=False only the header is read and the caller fills values.
+        The reader, codec and parser are released once the node is read.
         """
         self.reader = reader
         self.codec = codec
         self.parser = parser
-        self.tag_name_index = self.get_tag_name_index()
-        self.version = self.get_version()
-        self.offset = self.get_offset()
-        self.elements_length = self.get_elements_length()
-        self.values = self.get_values()
+        self.tag_name_index, self.version = self.get_tag()
+        self.offset, self.elements_length = self.get_extent()
+        self.values = self.get_values() if decode_body else []
+        self.release()
 
+    def release(self):
+        """
+        Drop the decoding machinery; the attributes stay, set to None.
+        """
+        self.reader = None
+        self.codec = None
+        self.parser = None
+
+    def get_tag(self):
+        return self.codec.read_record_tag(self.reader)
+
+    def get_extent(self):
+        return self.codec.read_array_header(self.reader)
+
+    # the header is read by get_tag and get_extent; these return what they decoded
     def get_tag_name_index(self):
-        return self.reader.read_uint16_value()
+        return self.tag_name_index
 
     def get_version(self):
-        return self.reader.read_uint8_value()
-
-    def get_offset(self):
-        return self.reader.read_uint32_value()
+        return self.version
 
     def get_elements_length(self):
-        return self.reader.read_uint32_value()
+        return self.elements_length
 
     def get_values(self):
         values = []
@@ -377,7 +581,7 @@ class RecordArrayNode:
             if self.reader.index >= self.offset:
                 break
             else:
-                element_offset = self.reader.read_uint32_value()
+                element_offset = self.codec.read_offset(self.reader)
                 child_node = ChildNode()
                 while True:
                     if self.reader.index >= element_offset:
@@ -393,9 +597,91 @@ class RecordArrayNode:
                 values.append(child_node)
         return values
 
+    def __getstate__(self):
+        return get_state(self)
+
+    def __setstate__(self, state):
+        set_state(self, state)
+
+
+class ChildNode(object):
+    __slots__ = ('children', 'values')
 
-class ChildNode:
     def __init__(self):
         self.children = []
         self.values = []
 
+    def __getstate__(self):
+        return get_state(self)
+
+    def __setstate__(self, state):
+        set_state(self, state)
+
+
+class LazyRecordNode(RecordNode):
+    """
+    RecordNode that only reads its header and skips to the stored end offset.
+    children and values are decoded on first access.
+    """
+
+    def __init__(self, reader, codec, parser, is_parent=False):
+        self.reader = reader
+        self.codec = codec
+        self.parser = parser
+        self.tag_name_index, self.version = self.get_tag()
+        self.offset = self.get_offset()
+        self.start = self.reader.index
+        self.reader.index = self.offset
+
+    def __getattr__(self, name):
+        if name not in ('children', 'values'):
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def load(self):
+        index = self.reader.index
+        self.reader.index = self.start
+        self.children = []
+        self.values = []
+        self.get_nodes()
+        self.reader.index = index
+        self.release()
+
+    def __getstate__(self):
+        self.children
+        return RecordNode.__getstate__(self)
+
+
+class LazyRecordArrayNode(RecordArrayNode):
+    """
+    RecordArrayNode that only reads its header and skips to the stored end offset.
+    values are decoded on first access.
+    """
+
+    def __init__(self,reader,codec, parser):
+        self.reader = reader
+        self.codec = codec
+        self.parser = parser
+        self.tag_name_index, self.version = self.get_tag()
+        self.offset, self.elements_length = self.get_extent()
+        self.start = self.reader.index
+        self.reader.index = self.offset
+
+    def __getattr__(self, name):
+        if name != 'values':
+            raise AttributeError(name)
+        self.load()
+        return self.values
+
+    def load(self):
+        index = self.reader.index
+        self.reader.index = self.start
+        self.values = self.get_values()
+        self.reader.index = index
+        self.release()
+
+    def __getstate__(self):
+        self.values
+        return RecordArrayNode.__getstate__(self)
+
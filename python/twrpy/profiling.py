@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from twrpy.parser import Parser
+from twrpy.serializer import to_leaf
+from twrpy.types import TypeCodes
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def type_code_names():
+    names = {}
+    for name in dir(TypeCodes):
+        value = getattr(TypeCodes, name)
+        if not name.startswith('_') and isinstance(value, int):
+            names[value] = name
+    return names
+
+
+# Parser methods that route every value through codec.decoders; a subclass overriding one is not profiled
+DECODING_METHODS = ('bind_codec', 'get_nodes', 'decode', 'read_recode_node', 'read_recode_array_node')
+
+
+def get_function(cls, name):
+    method = getattr(cls, name)
+    return getattr(method, '__func__', method)
+
+
+class DecodeProfile(object):
+    """
+    Counts nodes, bytes and seconds per type code and per record tag while a parser decodes.
+
+    Pass an instance to the parser (Parser(reader, codec, profile=profile)). install()
+    replaces the entries of codec.decoders with timing wrappers, so a parser without a
+    profile runs the plain table and pays nothing. Parsers that change how values reach the
+    table (DECODING_METHODS) are refused: StackParser and ParallelParser walk the node
+    region their own way, and LazyParser decodes records after the parse.
+
+    type_stats: type code -> [count, bytes, seconds]; record times include their contents
+    tag_stats: tag -> [count, bytes, seconds, self seconds]; self time excludes nested records
+    stacks: tag path tuple -> self seconds, see write_collapsed
+    Tags are the names from footer['tags'] as text when given, tag name indexes otherwise.
+    """
+
+    def __init__(self, tags=None):
+        self.tags = tags
+        self.type_stats = {}
+        self.tag_stats = {}
+        self.stacks = {}
+        self.path = []
+        # seconds spent in nested records, one entry per open record
+        self.nested = [0.0]
+
+    def install(self, codec, parser_class):
+        for name in DECODING_METHODS:
+            if get_function(parser_class, name) is not get_function(Parser, name):
+                raise ValueError('%s does not decode every value through codec.decoders, it cannot be profiled'
+                                 % parser_class.__name__)
+        if self.tags is None and codec.FOOTER:
+            self.tags = codec.FOOTER['tags']
+        if self.tags is not None:
+            # footer tags are bytes; flamegraph.pl and report() want the names
+            self.tags = [to_leaf(tag) for tag in self.tags]
+        decoders = codec.decoders
+        for code, decode in enumerate(decoders):
+            if codec.RECORD_KINDS[code] is not None:
+                decoders[code] = self.wrap_record(code, decode, codec, parser_class)
+            else:
+                decoders[code] = self.wrap_value(code, decode)
+
+    def uninstall(self, codec):
+        """
+        Put back the decoders install() wrapped.
+        """
+        decoders = codec.decoders
+        for code, decode in enumerate(decoders):
+            decoders[code] = getattr(decode, 'wrapped', decode)
+
+    def get_type_stats(self, code):
+        stats = self.type_stats.get(code)
+        if stats is None:
+            stats = self.type_stats[code] = [0, 0, 0.0]
+        return stats
+
+    def wrap_value(self, code, decode):
+        stats = self.get_type_stats(code)
+
+        def profiled(reader):
+            index = reader.index
+            start = timer()
+            value = decode(reader)
+            stats[2] += timer() - start
+            stats[0] += 1
+            # the type code byte was read before the decoder ran
+            stats[1] += reader.index - index + 1
+            return value
+        profiled.wrapped = decode
+        return profiled
+
+    def wrap_record(self, code, decode, codec, parser_class):
+        stats = self.get_type_stats(code)
+        read_record_header = parser_class.read_record_header
+        path = self.path
+        nested = self.nested
+
+        def profiled(reader):
+            index = reader.index
+            tag = read_record_header(reader, codec, code)[0]
+            reader.index = index
+            if self.tags is not None:
+                tag = self.tags[tag]
+            path.append(tag)
+            nested.append(0.0)
+            start = timer()
+            try:
+                value = decode(reader)
+            finally:
+                elapsed = timer() - start
+                inner = nested.pop()
+                key = tuple(path)
+                path.pop()
+            nested[-1] += elapsed
+            size = reader.index - index + 1
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += elapsed
+            tag_stats = self.tag_stats.get(tag)
+            if tag_stats is None:
+                tag_stats = self.tag_stats[tag] = [0, 0, 0.0, 0.0]
+            tag_stats[0] += 1
+            tag_stats[1] += size
+            tag_stats[2] += elapsed
+            tag_stats[3] += elapsed - inner
+            self.stacks[key] = self.stacks.get(key, 0.0) + elapsed - inner
+            return value
+        profiled.wrapped = decode
+        return profiled
+
+    def write_collapsed(self, fp, scale=1e6):
+        """
+        Write stacks in the collapsed format of flamegraph.pl ("a;b;c count"), counts in microseconds.
+        """
+        for key, seconds in sorted(self.stacks.items()):
+            fp.write('%s %d\n' % (';'.join('%s' % tag for tag in key), int(seconds * scale)))
+
+    def report(self, limit=20):
+        """
+        Text tables of the type codes and tags that took the most time.
+        """
+        names = type_code_names()
+        lines = ['%-20s %10s %12s %10s' % ('type code', 'count', 'bytes', 'seconds')]
+        for code, stats in sorted(self.type_stats.items(), key=lambda item: -item[1][2])[:limit]:
+            if stats[0]:
+                lines.append('%-20s %10d %12d %10.4f' % (names.get(code, hex(code)), stats[0], stats[1], stats[2]))
+        lines.append('')
+        lines.append('%-40s %10s %12s %10s %10s' % ('tag', 'count', 'bytes', 'seconds', 'self'))
+        for tag, stats in sorted(self.tag_stats.items(), key=lambda item: -item[1][3])[:limit]:
+            lines.append('%-40s %10d %12d %10.4f %10.4f' % (tag, stats[0], stats[1], stats[2], stats[3]))
+        return '\n'.join(lines)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import mmap
 import struct
 
+try:
+    unichr
+except NameError:
+    unichr = chr # Python 3
+
 class BinaryReader:
     # http://www.python.jp/doc/2.7/library/struct.html
 
@@ -25,6 +31,7 @@ class BinaryReader:
         'pad' : struct.Struct('<x'),
         'bool' : struct.Struct('<?'),
         }
+    _UINT24 = struct.Struct('>HB')
 
     _FORMATS = {
         'int8' : 'b',
@@ -47,9 +54,13 @@ class BinaryReader:
         }
 
     def __init__(self, fp):
+        self.filename = getattr(fp, 'name', None)
         self.stream = fp.read()
         self.index = 0
         self.size = len(self.stream)
+        # raw bytes -> decoded string, so repeated strings are decoded once and shared
+        self.unicode_strings = {}
+        self.ascii_strings = {}
 
     def read(self,type, next=False):
         t = self._TYPES[type]
@@ -71,102 +82,101 @@ class BinaryReader:
     def next(self, count):
         return self.stream[self.index:self.index+count]
 
+    def get_bytes(self, start, end):
+        if end > self.size:
+            raise struct.error('unpack_from requires a buffer of at least %d bytes' % end)
+        return self.stream[start:end]
+
+    def read_values(self, type, count):
+        """
+        type[count] values, decoded with a single unpack_from
+        """
+        values = struct.unpack_from('<%d%s' % (count, self._FORMATS[type]), self.stream, self.index)
+        self.index += count * self._TYPES[type].size
+        return values
+
     def read_bool_value(self):
         t = self._TYPES['bool']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_int8_value(self):
         t = self._TYPES['int8']
         value = t.unpack_from(self.stream, self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_int16_value(self):
         t = self._TYPES['int16']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_int32_value(self):
         t = self._TYPES['int32']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_int64_value(self):
         t = self._TYPES['int64']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_uint8_value(self):
         t = self._TYPES['uint8']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_uint16_value(self):
         t = self._TYPES['uint16']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_uint32_value(self):
         t = self._TYPES['uint32']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_uint64_value(self):
         t = self._TYPES['uint64']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_float32_value(self):
         t = self._TYPES['float32']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_float64_value(self):
         t = self._TYPES['float64']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_char8_value(self):
         t = self._TYPES['char8']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_char16_value(self):
         t = self._TYPES['char16']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_pad_value(self):
         t = self._TYPES['pad']
         value = t.unpack_from(self.stream,self.index)[0]
         self.index += t.size
-        self.next(t.size)
         return value
 
     def read_ca_unicode_value(self):
@@ -176,11 +186,19 @@ class BinaryReader:
         """
         t = self._TYPES['uint16']
         string_length = t.unpack_from(self.stream,self.index)[0]
-        self.index += t.size
-        self.next(t.size)
-        value = unicode()
-        for i in range(string_length):
-            value += unichr(self.read_uint16_value())
+        start = self.index + t.size
+        raw = self.get_bytes(start, start + string_length*2)
+        self.index = start + string_length*2
+        value = self.unicode_strings.get(raw)
+        if value is None:
+            try:
+                value = raw.decode('utf-16-le')
+            except UnicodeDecodeError:
+                value = None
+            if value is None or len(value) != string_length:
+                # surrogates: keep one codepoint per code unit
+                value = u''.join([unichr(c) for c in struct.unpack('<%dH' % string_length, raw)])
+            self.unicode_strings[raw] = value
         return value
 
     def read_ca_ascii_value(self):
@@ -190,31 +208,100 @@ class BinaryReader:
         """
         t = self._TYPES['uint16']
         string_length = t.unpack_from(self.stream,self.index)[0]
-        self.index += t.size
-        self.next(t.size)
-        value = ''
-        for i in range(string_length):
-            value += self.read_char8_value()
-        return value
+        start = self.index + t.size
+        raw = self.get_bytes(start, start + string_length)
+        self.index = start + string_length
+        return self.ascii_strings.setdefault(raw, raw)
+
+    def read_uint8_at(self, index):
+        """
+        uint8 at index, without moving the reader
+        """
+        return self._TYPES['uint8'].unpack_from(self.stream, index)[0]
+
+    def read_uintvar_value(self):
+        """
+        uintvar: 7 bits per byte, most significant first, 0x80 set on every byte but the last.
+        Sizes under 128 take the one-byte path; longer ones are decoded from a single slice.
+        """
+        t = self._TYPES['uint8']
+        value = t.unpack_from(self.stream, self.index)[0]
+        self.index += 1
+        if value < 0x80:
+            return value
+        result = value & 0x7f
+        for value in bytearray(self.get_bytes(self.index, min(self.index + 8, self.size))):
+            self.index += 1
+            result = (result << 7) | (value & 0x7f)
+            if value < 0x80:
+                return result
+        raise struct.error('unterminated uintvar at %d' % self.index)
 
     def read_int24_value(self):
         """
-        uintvar is a variable length encoding for unsigned integers
-        int24be
-        max 5bytes
+        int24be: sign bit, then a 23 bit magnitude
         """
-        value = self.read_int8_value()
-        sigh = (value & 0x80) != 0
-        value = value & 0x7f
-        for i in range(2):
-            value = (value << 8) + self.read_int8_value()
-        if sigh:
-            value = (-1 * value)
+        value = self.read_uint24_value()
+        if value & 0x800000:
+            return -(value & 0x7fffff)
         return value
 
     def read_uint24_value(self):
-        value = 0
-        for i in range(2):
-            value = (value << 8) + self.read_int8_value()
-        return
+        """
+        uint24be
+        """
+        high, low = self._UINT24.unpack_from(self.stream, self.index)
+        self.index += 3
+        return (high << 8) | low
+
+    def read_uint24_values(self, count):
+        """
+        uint24be[count], widened to uint32be in one pass and decoded with a single unpack
+        """
+        raw = self.get_bytes(self.index, self.index + count * 3)
+        self.index += count * 3
+        words = bytearray(count * 4)
+        words[1::4] = raw[0::3]
+        words[2::4] = raw[1::3]
+        words[3::4] = raw[2::3]
+        return struct.unpack('>%dI' % count, bytes(words))
+
+    def read_int24_values(self, count):
+        return [-(value & 0x7fffff) if value & 0x800000 else value for value in self.read_uint24_values(count)]
+
+
+class MappedBinaryReader(BinaryReader):
+    """
+    BinaryReader backed by a read-only mmap of the replay file.
+    Nothing is copied up front; every read is an unpack_from on the mapped buffer.
+    """
+
+    def __init__(self, fp):
+        self.filename = getattr(fp, 'name', None)
+        self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.stream = memoryview(self.map)
+        except TypeError:
+            # python2 mmap has only the old buffer interface, unpack_from accepts it as is
+            self.stream = self.map
+        self.index = 0
+        self.size = len(self.map)
+        self.unicode_strings = {}
+        self.ascii_strings = {}
+
+    def next(self, count):
+        if isinstance(self.stream, memoryview):
+            return self.stream[self.index:self.index+count]
+        return buffer(self.stream, self.index, count)
+
+    def get_bytes(self, start, end):
+        if end > self.size:
+            raise struct.error('unpack_from requires a buffer of at least %d bytes' % end)
+        # slicing the map copies; a memoryview slice would keep the map exported
+        return self.map[start:end]
 
+    def close(self):
+        if isinstance(self.stream, memoryview):
+            self.stream.release()
+        self.stream = None
+        self.map.close()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import itertools
+import sys
+
 try:
     import simplejson as json
 except ImportError:
@@ -12,15 +15,179 @@ except ImportError:
         except ImportError:
             raise ImportError("Can't load a json library")
 
-class ComplexEncoder(json.JSONEncoder):
-    def default(self, o):
-        if not type(o) in [int, float, str, unicode, list, dict]:
-            value = eval(self.encode(o.__enc_json__()))
-            name = o.__class__.__name__
-            return {"__class__": name, "__value__":value}
+from twrpy.nodes import BaseNode, RecordNode, RecordArrayNode, ChildNode
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+# chunks handed to fp.write at once
+WRITE_BUFFER = 4096
+
+
+class _Raw(object):
+    """
+    Text emitted as is between two item lists of one container.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+
+def to_leaf(value):
+    """
+    JSON-ready form of a value that is not a record.
+    ca_ascii strings are bytes; latin-1 maps every byte to a codepoint.
+    """
+    if value is BaseNode:
+        return None
+    elif isinstance(value, bytes):
+        return value.decode('latin-1')
+    elif isinstance(value, list) and value and isinstance(value[0], bytes):
+        return [item.decode('latin-1') for item in value]
+    return value
+
+
+def get_tag(node, tags):
+    if tags is None:
+        return node.tag_name_index
+    return to_leaf(tags[node.tag_name_index])
+
+
+def open_container(node, tags, encode):
+    """
+    (opening text, items, closing text) of a record
+    """
+    if isinstance(node, RecordNode):
+        head = '{"__class__":"RecordNode","__value__":{"tag":%s,"version":%d,"children":[' % (
+            encode(get_tag(node, tags)), node.version)
+        return head, itertools.chain(node.children, [_Raw('],"values":[')], node.values), ']}}'
+    elif isinstance(node, RecordArrayNode):
+        head = '{"__class__":"RecordArrayNode","__value__":{"tag":%s,"version":%d,"values":[' % (
+            encode(get_tag(node, tags)), node.version)
+        return head, iter(node.values), ']}}'
+    head = '{"__class__":"ChildNode","__value__":{"children":['
+    return head, itertools.chain(node.children, [_Raw('],"values":[')], node.values), ']}}'
+
+
+def iterencode(obj, tags=None):
+    """
+    Yield the JSON text of obj (a node, a value or a list of them) in small chunks.
+    Records are written as {"__class__": name, "__value__": {...}}; with the footer tags
+    given, tag name indexes are replaced by the names.
+
+    The tree is walked with an explicit stack, so only the chunks themselves are built.
+    """
+    encode = _encoder.encode
+    if isinstance(obj, list):
+        yield '['
+        stack = [(iter(obj), ']')]
+    else:
+        stack = [(iter([obj]), '')]
+    first = True
+    while stack:
+        items, closing = stack[-1]
+        for item in items:
+            if item.__class__ is _Raw:
+                yield item.text
+                first = True
+                continue
+            if not first:
+                yield ','
+            first = False
+            if isinstance(item, (RecordNode, RecordArrayNode, ChildNode)):
+                head, children, tail = open_container(item, tags, encode)
+                yield head
+                stack.append((children, tail))
+                first = True
+                break
+            yield encode(to_leaf(item))
         else:
-            return json.JSONEncoder.default(self,o)
+            stack.pop()
+            if closing:
+                yield closing
+            first = False
+
+
+def iterencode_ndjson(nodes, tags=None):
+    """
+    Yield one JSON line per RecordArrayNode element and per record holding plain values:
+        {"path": [tags from the top], "version": v, "element": i, "values": [...]}
+    "element" is only present for record array elements. Element values are written
+    whole, including the records nested in them.
+    """
+    encode = _encoder.encode
+    stack = [(node, []) for node in reversed(nodes)]
+    while stack:
+        node, path = stack.pop()
+        if isinstance(node, RecordNode):
+            path = path + [get_tag(node, tags)]
+            if node.values:
+                yield '{"path":%s,"version":%d,"values":%s}\n' % (
+                    encode(path), node.version, ''.join(iterencode(node.values, tags)))
+            stack.extend((child, path) for child in reversed(node.children))
+        elif isinstance(node, RecordArrayNode):
+            path = path + [get_tag(node, tags)]
+            for i, element in enumerate(node.values):
+                yield '{"path":%s,"version":%d,"element":%d,"values":%s}\n' % (
+                    encode(path), node.version, i, ''.join(iterencode(element.values, tags)))
+        else:
+            yield '{"path":%s,"values":%s}\n' % (encode(path), ''.join(iterencode([node], tags)))
+
+
+def write_chunks(chunks, fp):
+    buf = []
+    for chunk in chunks:
+        buf.append(chunk)
+        if len(buf) >= WRITE_BUFFER:
+            fp.write(''.join(buf))
+            buf = []
+    if buf:
+        fp.write(''.join(buf))
+
+
+def dump(obj, fp, tags=None):
+    """
+    Write obj as JSON to fp incrementally.
+    """
+    write_chunks(iterencode(obj, tags), fp)
+
+
+def dump_ndjson(nodes, fp, tags=None):
+    """
+    Write nodes as NDJSON to fp, see iterencode_ndjson.
+    """
+    write_chunks(iterencode_ndjson(nodes, tags), fp)
+
+
+def dumps(obj, tags=None):
+    return ''.join(iterencode(obj, tags))
+
+
+def main(argv=None):
+    import argparse
+    from twrpy.codecs import get_codec
+    from twrpy.parser import Parser
+    from twrpy.reader import MappedBinaryReader
+    argparser = argparse.ArgumentParser(description='Write a Total War replay as JSON.')
+    argparser.add_argument('path', help='replay file')
+    argparser.add_argument('--ndjson', action='store_true', help='one line per record array element')
+    args = argparser.parse_args(argv)
+
+    fp = open(args.path, 'rb')
+    try:
+        reader = MappedBinaryReader(fp)
+        try:
+            parser = Parser(reader, get_codec(reader))
+        finally:
+            reader.close()
+    finally:
+        fp.close()
+    if args.ndjson:
+        dump_ndjson(parser.nodes, sys.stdout, parser.footer['tags'])
+    else:
+        dump(parser.nodes, sys.stdout, parser.footer['tags'])
+        sys.stdout.write('\n')
+    return 0
 
 
-def dumps(obj):
-    return json.dumps(obj,cls=ComplexEncoder)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import mmap
+import struct
+
+from twrpy.flat import COLUMNS, FlatTree, decode_string, from_parser
+from twrpy.parser import Parser
+from twrpy.reader import BinaryReader
+from twrpy.util import atomic_write, column_bytes
+
+
+class Snapshot(FlatTree):
+    """
+    FlatTree stored in a file.
+
+    File:
+        char[4] magic 'TWRS'
+        uint16 format version
+        uint16 zero
+        char[16] header of the replay
+        uint32[9] counts: records, values, ints, uints, floats, strings, string bytes, tags, ex_values
+        columns, little endian, each starting at an 8 byte boundary, in the order of COLUMNS
+
+    Opening a snapshot maps the file; records are read when accessed. A file too short
+    for the counts in its header raises ValueError.
+    """
+
+    MAGIC = b'TWRS'
+    VERSION = 3
+    _HEADER = struct.Struct('<4sHH16s9I')
+    COLUMNS = COLUMNS
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.map = None
+        try:
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            fields = self._HEADER.unpack_from(self.map, 0)
+            magic, version, zero, raw_header = fields[:4]
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('Not a replay snapshot(%s).' % path)
+            counts = fields[4:]
+            # name -> (struct of one item, typecode, file offset, count)
+            self.layout = {}
+            size = 0
+            for name, typecode, offset, count in column_layout(counts):
+                t = struct.Struct('<' + typecode)
+                self.layout[name] = (t, typecode, offset, count)
+                size = offset + t.size * count
+            if len(self.map) < size:
+                raise ValueError('Truncated replay snapshot(%s).' % path)
+        except BaseException:
+            self.close()
+            raise
+        footer = {'tags': [self.get_string(i) for i in self.read_column('tags', 0, counts[7])]}
+        if counts[8]:
+            keys = self.read_column('ex_keys', 0, counts[8])
+            strings = self.read_column('ex_strings', 0, counts[8])
+            footer['ex_values'] = dict((key, self.get_string(i)) for key, i in zip(keys, strings))
+        header = Parser.get_header(BinaryReader(io.BytesIO(raw_header)))
+        FlatTree.__init__(self, raw_header, header, footer, None)
+
+    def __len__(self):
+        return self.layout['record_kinds'][3]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fp.close()
+
+    def read(self, name, index):
+        t, typecode, offset, count = self.layout[name]
+        return t.unpack_from(self.map, offset + index * t.size)[0]
+
+    def read_column(self, name, start, count):
+        t, typecode, offset, total = self.layout[name]
+        return struct.unpack_from('<%d%s' % (count, typecode), self.map, offset + start * t.size)
+
+    def get_string(self, string_id):
+        start, end = self.read_column('string_offsets', string_id, 2)
+        offset = self.layout['string_data'][2]
+        return decode_string(self.map[offset + start:offset + end])
+
+
+def column_layout(counts):
+    """
+    (name, typecode, file offset, count) of every column
+    """
+    layout = []
+    position = Snapshot._HEADER.size
+    for name, typecode, count_index in COLUMNS:
+        count = counts[count_index]
+        if name == 'string_offsets':
+            count += 1
+        position = (position + 7) & ~7
+        layout.append((name, typecode, position, count))
+        position += struct.calcsize('<' + typecode) * count
+    return layout
+
+
+def write_snapshot(tree, path):
+    """
+    Write a FlatTree to path.
+    """
+    columns = tree.columns
+    counts = (len(columns['record_kinds']), len(columns['value_kinds']), len(columns['ints']),
+              len(columns['uints']), len(columns['floats']), len(columns['string_offsets']) - 1,
+              len(columns['string_data']), len(columns['tags']), len(columns['ex_keys']))
+
+    def write(fp):
+        fp.write(Snapshot._HEADER.pack(Snapshot.MAGIC, Snapshot.VERSION, 0, tree.raw_header, *counts))
+        position = Snapshot._HEADER.size
+        for name, typecode, offset, count in column_layout(counts):
+            fp.write(b'\x00' * (offset - position))
+            data = column_bytes(columns[name], typecode)
+            fp.write(data)
+            position = offset + len(data)
+    atomic_write(path, write)
+
+
+def save_snapshot(parser, path):
+    """
+    Write the decoded tree of parser to path.
+    """
+    write_snapshot(from_parser(parser), path)
+
+
+def load_snapshot(path):
+    return Snapshot(path)
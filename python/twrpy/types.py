@@ -73,4 +73,29 @@ class TypeCodes:
     INT32_BYTE_ARRAY = 0x5a
     INT32_SHORT_ARRAY = 0x5b
     INT32_24BIT_ARRAY = 0x5c
-    SINGLE_ZERO_ARRAY = 0x5d # makes no sense
\ No newline at end of file
+    SINGLE_ZERO_ARRAY = 0x5d # makes no sense
+
+# packed type code (ABCA) -> type code of the same logical type; ABCA picks the packing per
+# value, so one field can appear under any code of its type
+PACKED_TYPES = {
+    TypeCodes.BOOL_TRUE: TypeCodes.BOOL,
+    TypeCodes.BOOL_FALSE: TypeCodes.BOOL,
+    TypeCodes.UINT32_ZERO: TypeCodes.UINT32,
+    TypeCodes.UINT32_ONE: TypeCodes.UINT32,
+    TypeCodes.UINT32_BYTE: TypeCodes.UINT32,
+    TypeCodes.UINT32_SHORT: TypeCodes.UINT32,
+    TypeCodes.UINT32_24BIT: TypeCodes.UINT32,
+    TypeCodes.INT32_ZERO: TypeCodes.INT32,
+    TypeCodes.INT32_BYTE: TypeCodes.INT32,
+    TypeCodes.INT32_SHORT: TypeCodes.INT32,
+    TypeCodes.INT32_24BIT: TypeCodes.INT32,
+    TypeCodes.FLOAT32_ZERO: TypeCodes.FLOAT32,
+    TypeCodes.BOOL_TRUE_ARRAY: TypeCodes.BOOL_ARRAY,
+    TypeCodes.BOOL_FALSE_ARRAY: TypeCodes.BOOL_ARRAY,
+    TypeCodes.UINT32_BYTE_ARRAY: TypeCodes.UINT32_ARRAY,
+    TypeCodes.UINT32_SHORT_ARRAY: TypeCodes.UINT32_ARRAY,
+    TypeCodes.UINT32_24BIT_ARRAY: TypeCodes.UINT32_ARRAY,
+    TypeCodes.INT32_BYTE_ARRAY: TypeCodes.INT32_ARRAY,
+    TypeCodes.INT32_SHORT_ARRAY: TypeCodes.INT32_ARRAY,
+    TypeCodes.INT32_24BIT_ARRAY: TypeCodes.INT32_ARRAY,
+}
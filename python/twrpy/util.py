@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import os
+import struct
+import sys
+import tempfile
+
+# os.replace overwrites an existing file on every platform; Python 2 only has os.rename
+replace = getattr(os, 'replace', os.rename)
+
+
+def atomic_write(path, data):
+    """
+    Write data (bytes, or a function writing to the file object it is given) to a temporary
+    file next to path and rename it into place, so that readers never see a partly written
+    file and concurrent writers do not share one. The temporary file is removed on failure.
+    """
+    fd, tmp_path = tempfile.mkstemp('.tmp', os.path.basename(path) + '.', os.path.dirname(os.path.abspath(path)))
+    fp = os.fdopen(fd, 'wb')
+    try:
+        try:
+            if callable(data):
+                data(fp)
+            else:
+                fp.write(data)
+        finally:
+            fp.close()
+        replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def array_to_bytes(column):
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+
+def array_from_bytes(column, data):
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+
+
+def column_bytes(column, typecode):
+    """
+    Little endian bytes of column stored as typecode. A bytearray is returned as is, arrays of
+    that item size are copied once, other sequences (the list fallback of new_array) are packed.
+    """
+    if isinstance(column, bytearray):
+        return column
+    if not isinstance(column, array.array) or column.itemsize != struct.calcsize('<' + typecode):
+        return struct.pack('<%d%s' % (len(column), typecode), *column)
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return array_to_bytes(column)